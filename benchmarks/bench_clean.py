@@ -0,0 +1,94 @@
+# Author: Stephen Meisenbacher
+# bench_clean.py
+# docs/sec of the previous (sequential re.sub / replace) cleaning chain vs. classes/Cleaner.py
+# usage: python benchmarks/bench_clean.py [num docs]
+
+import sys
+import re
+import time
+import json
+import random
+from html import unescape
+from bs4 import BeautifulSoup
+from pathlib import Path
+
+sys.path.append("classes")
+from Cleaner import clean, clean_text
+
+# previous implementation of Extract.clean (KEEP_NUM=False)
+def old_clean(text):
+    if '&' in text:
+        text = unescape(text.strip())
+    if '<' in text:
+        text = BeautifulSoup(text, "lxml").text
+    text = re.sub(r"www\S+", " ", text)
+    text = re.sub(r"\b(?![ai])[a-zA-Z]\b", " ", text)
+    text = re.sub(r"\d+", " ", text)
+    text = text.replace(',','')
+    text = text.replace(':','.').replace('*','.')
+    text = text.replace(' .', '.')
+    text = text.encode("ascii", "ignore").decode()
+    text = text.replace("-site", "site").replace(" site", "site")
+    text = text.replace("-life", "life").replace(" life", "life")
+    text = text.replace(" s "," ")
+    return text
+
+# previous implementation of pdf_to_text.clean
+def old_clean_text(text, ABBREV):
+    if '&' in text:
+        text = unescape(text.strip())
+    if '<' in text:
+        text = BeautifulSoup(text, "lxml").text
+    text = re.sub(r"www\S+", " ", text)
+    text = re.sub(r"\b(?![ai])[a-zA-Z]\b", " ", text)
+    text = re.sub(r"\d+", " ", text)
+    text = text.replace(',',' ')
+    text = text.replace(':',' ').replace('*',' ')
+    text = text.encode("ascii", "ignore").decode()
+    text = re.sub(r"[^0-9a-zA-Z\.\?\! ]+", " ", text)
+    text = " ".join(text.split())
+    text = text.replace(" .", ".")
+    text = re.sub(r"\.{2,}", ".", text)
+    text = " ".join([ABBREV.get(x.lower(), x) for x in text.split()])
+    text = re.sub(r"(?<!\w)([A-Za-z])\.", r"\1", text)
+    text = text.lower()
+    return text
+
+WORDS = ["the", "employee", "shall", "not", "compete", "non-compete", "on-site", "work life", "policy", "a", "i", "x",
+            "agreement", "2021", "$1,500.00", "15%", "www.example.com", "e.g.", "etc.", "inc.", "U.S.", "café",
+            "term:", "note*", "clause,", "section", "a < b", "\n", "s"]
+MARKUP = ["<b>compete</b>", "line<br>break", "<i>policy</i>", "terms &amp; conditions", "<span class=x>section</span>"]
+
+# fixed corpus: same seed, same documents on every run
+def make_corpus(num_docs, doc_words=300, seed=42):
+    rand = random.Random(seed)
+    corpus = []
+    for i in range(num_docs):
+        words = [rand.choice(WORDS) for _ in range(doc_words)]
+        if i % 4 == 0:
+            words = [rand.choice(WORDS + MARKUP) for _ in range(doc_words)] # inline markup every fourth doc
+        if i % 10 == 0:
+            words = ["<div class=\"body\"><p>"] + words + ["</p></div>"] # real html every tenth doc
+        corpus.append(" ".join(words))
+    return corpus
+
+def docs_per_sec(func, corpus):
+    start = time.perf_counter()
+    for doc in corpus:
+        func(doc)
+    return len(corpus) / (time.perf_counter() - start)
+
+if __name__ == "__main__":
+    num_docs = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    corpus = make_corpus(num_docs)
+    with open((Path("assets") / "abbrev.json").as_posix(), 'r') as f:
+        abbrev = json.load(f)
+
+    assert all(old_clean(d) == clean(d) for d in corpus)
+    assert all(old_clean_text(d, abbrev) == clean_text(d, abbrev) for d in corpus)
+
+    for name, old, new in [("extract clean", old_clean, clean),
+                            ("pdf-to-text clean", lambda x: old_clean_text(x, abbrev), lambda x: clean_text(x, abbrev))]:
+        before = docs_per_sec(old, corpus)
+        after = docs_per_sec(new, corpus)
+        print("{}: {:.0f} docs/sec before, {:.0f} docs/sec after ({:.2f}x) on {} docs".format(name, before, after, after / before, num_docs))
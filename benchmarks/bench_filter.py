@@ -0,0 +1,100 @@
+# Author: Stephen Meisenbacher
+# bench_filter.py
+# rows/sec of the original keyword filter (substring scans per keyword) vs. Extract.filter_data, same rows checked first
+# usage: python benchmarks/bench_filter.py [num rows]
+
+import re
+import sys
+import time
+import random
+
+sys.path.append("classes")
+from Extract import filter_data, clean
+
+WORDS = ["the", "cat", "life", "is", "good", "dog", "non-compete", "e.g.", "fish.", "Tree!", "a,b", "42", "x?"]
+KEYS = [["cat "], [" dog", "cat"], ["non-compete", "e.g."], ["fish.", "tree!"], ["zz"], ["42 ", "a,b"]]
+
+# the filter as it was before the keyword automata (text entries only)
+def get_context(text, keywords, n, MODE="word"):
+    if MODE == "word":
+        text = re.sub(r'[^a-z0-9]+', ' ', text)
+    else:
+        text = re.sub(r'[^a-z0-9.!?]+', ' ', text)
+        text = '. '.join(text.split('.'))
+        if '?' in text:
+            text = '? '.join(text.split('?'))
+        if '!' in text:
+            text = '! '.join(text.split('!'))
+        text = text.replace('?', '.').replace('!', '.')
+
+    if MODE == "word":
+        words = text.split()
+    else:
+        words = [x.strip() for x in text.split('.')]
+
+    found_index = [i for i, w in enumerate(words) if any(k.strip() in w for k in keywords)]
+    context = [" ".join(words[max(0, idx-n):min(idx+n+1, len(words))]) for idx in found_index]
+
+    return '|'.join(context)
+
+def _filter_helper_(arg):
+    if any(a in arg[0] for a in arg[1]):
+        return True
+    else:
+        return False
+
+def old_filter_data(entry, KEYS=None, n=None, MODE=None, KEEP_NUM=False):
+    text = str(entry["text"])
+    if text is None or text == "":
+        return None
+
+    keywords = KEYS
+    if any(w in text for w in keywords):
+        text = clean(text, KEEP_NUM)
+
+        keep = []
+        text = text.lower()
+        args = ((text, k) for k in keywords)
+        res = set(map(_filter_helper_, args))
+        if True in res:
+            context = get_context(text, keywords, n, MODE)
+            keep.append(context)
+
+        keep = list(set(keep))
+        return ":::".join([str(entry[x]) for x in entry.keys() if x != "text"]+["|".join(keep)])
+    else:
+        return None
+
+def new_filter_data(entry, KEYS=None, n=None, MODE=None, KEEP_NUM=False):
+    r = filter_data(entry, KEYS=KEYS, n=n, MODE=MODE, KEEP_NUM=KEEP_NUM)
+    return ":::".join(r) if r else None
+
+def make_entries(rand, num_rows):
+    return [{"id":str(i), "text":" ".join(rand.choice(WORDS) for _ in range(rand.randint(1, 12)))} for i in range(num_rows)]
+
+def same(entries, keys, n, mode):
+    return all(old_filter_data(e, keys, n, mode) == new_filter_data(e, keys, n, mode) for e in entries)
+
+if __name__ == "__main__":
+    num_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    rand = random.Random(42)
+
+    # "cat " is in the raw text but not in the cleaned one: the row is kept, as it always was
+    entry = {"id":"0", "text":"the cat life is good"}
+    assert old_filter_data(entry, ["cat "], 2, "word") == new_filter_data(entry, ["cat "], 2, "word") != None
+
+    entries = make_entries(rand, 2000)
+    for keys in KEYS:
+        for n, mode in [(2, "word"), (1, "sent")]:
+            assert same(entries, keys, n, mode), (keys, mode)
+
+    entries = make_entries(rand, num_rows)
+    start = time.perf_counter()
+    for e in entries:
+        old_filter_data(e, ["cat ", " dog", "e.g."], 2, "word")
+    before = num_rows / (time.perf_counter() - start)
+    start = time.perf_counter()
+    for e in entries:
+        new_filter_data(e, ["cat ", " dog", "e.g."], 2, "word")
+    after = num_rows / (time.perf_counter() - start)
+    print("keyword filtering: {:.0f} rows/sec before, {:.0f} rows/sec after ({:.2f}x) on {} rows".format(before, after, after / before, num_rows))
@@ -0,0 +1,68 @@
+# Author: Stephen Meisenbacher
+# bench_match_shard.py
+# rows/sec of row-by-row rule matching (Extrapolate.get_matches) vs. the vectorized match_shard, same results checked first
+# usage: python benchmarks/bench_match_shard.py [num rows]
+
+import sys
+import time
+import random
+import pandas as pd
+
+sys.path.append("classes")
+from Matcher import get_rule_set
+from Extrapolate import Extrapolate, match_shard
+
+VOCAB = ["cat", "dog", "bird", "fish", "tree", "car", "red", "blue", "big", "small"]
+REGEX = [r"\bca\w", r"d.g", r"^red", r"fish$", r"bl(ue|ack)", r"x+y"]
+
+# rule table as read_rule_table returns it: rules, tags, rule -> {prio, encoding}
+def make_rules(rand, tags, num_rules):
+    rules = []
+    for _ in range(num_rules):
+        if rand.random() < 0.15:
+            r = "REGEX:::" + rand.choice(REGEX)
+        else:
+            r = " ".join(rand.sample(VOCAB, rand.randint(1, 2)))
+        if r not in rules:
+            rules.append(r)
+    rule_tags = {r:{"prio":rand.randint(0, 3), "encoding":{t:rand.randint(0, 1) for t in tags}} for r in rules}
+    return rules, tags, rule_tags
+
+def make_texts(rand, num_rows):
+    return ["|".join(" ".join(rand.choice(VOCAB) for _ in range(rand.randint(1, 5))) for _ in range(rand.randint(1, 6)))
+                for _ in range(num_rows)]
+
+def row_by_row(texts, rules, tags, rule_tags):
+    rule_set = get_rule_set(rules)
+    rows = [Extrapolate.get_matches(None, {"text":t}, rule_set, tags, rule_tags) for t in texts]
+    return pd.DataFrame(rows, columns=tags).astype(int)
+
+def vectorized(texts, rules, tags, rule_tags):
+    return match_shard(texts, get_rule_set(rules), tags, rule_tags).astype(int)
+
+def same(texts, rules, tags, rule_tags):
+    return row_by_row(texts, rules, tags, rule_tags).equals(vectorized(texts, rules, tags, rule_tags))
+
+if __name__ == "__main__":
+    num_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    rand = random.Random(42)
+
+    # edge cases: only regex rules hit (nothing left after the plain-rule filter), no hits at all, empty shard
+    edge = {"t1":{"prio":1, "encoding":{"t1":1}}, "t2":{"prio":0, "encoding":{"t1":0}}}
+    assert same(["xy e|f", "zz"], ["REGEX:::x+y", "abc"], ["t1"], {"REGEX:::x+y":edge["t1"], "abc":edge["t2"]})
+    assert same(["zz", "e|f"], ["REGEX:::x+y", "abc"], ["t1"], {"REGEX:::x+y":edge["t1"], "abc":edge["t2"]})
+    assert same([], ["abc"], ["t1"], {"abc":edge["t1"]})
+
+    for _ in range(50):
+        rules, tags, rule_tags = make_rules(rand, rand.choice([["t1", "t2"], ["t3"]]), rand.randint(1, 12))
+        assert same(make_texts(rand, rand.randint(1, 60)), rules, tags, rule_tags)
+
+    rules, tags, rule_tags = make_rules(rand, ["t1", "t2", "t3"], 40)
+    texts = make_texts(rand, num_rows)
+    start = time.perf_counter()
+    row_by_row(texts, rules, tags, rule_tags)
+    before = num_rows / (time.perf_counter() - start)
+    start = time.perf_counter()
+    vectorized(texts, rules, tags, rule_tags)
+    after = num_rows / (time.perf_counter() - start)
+    print("rule matching: {:.0f} rows/sec before, {:.0f} rows/sec after ({:.2f}x) on {} rows".format(before, after, after / before, num_rows))
@@ -0,0 +1,94 @@
+# Author: Stephen Meisenbacher
+# bench_xml_slices.py
+# rows/sec of whole-file xml parsing vs. parsing in record slices (Extract.parse_xml), same rows checked first
+# usage: python benchmarks/bench_xml_slices.py [num records]
+
+import sys
+import time
+import random
+import tempfile
+from pathlib import Path
+from contextlib import closing
+from lxml import etree
+
+sys.path.append(".")
+sys.path.append("classes")
+import Extract
+from Extract import Extract as Extractor, find_xml_slices, generate_entries, filter_data, mp
+
+FIELDS = ["ident", "title", "text"]
+TAGS = ("ident", "title", "body")
+KEYS = ["cat", "dog"]
+WORDS = ["cat", "dog", "bird", "fish", "tree", "&amp; more"]
+
+# records as <rec><ident/><title/><body/></rec>; nested: <rec><meta><ident/></meta>...</rec>; quoted: with CDATA / comments
+def make_xml(rand, num_records, nested=False, quoted=False):
+    recs = []
+    for i in range(num_records):
+        ident = "<ident>{}</ident>".format(i)
+        if nested == True:
+            ident = "<meta>{}<source>s</source></meta>".format(ident)
+        extra = ""
+        if quoted == True and i % 7 == 0:
+            extra = "<!-- <rec> -->" if i % 2 == 0 else "<note><![CDATA[<rec> x ]]></note>"
+        body = " ".join(rand.choice(WORDS) for _ in range(8))
+        recs.append("<rec>{}{}<title>t{}</title><body>{}</body></rec>".format(ident, extra, i, body))
+    return '<?xml version="1.0" encoding="UTF-8"?>\n<root>\n' + "\n".join(recs) + "\n</root>\n"
+
+# reference: the whole file parsed and filtered in order
+def whole_rows(fname):
+    xml = etree.iterparse(fname, events=('end',), tag=TAGS)
+    rows = (filter_data(e, KEYS=KEYS, n=2, MODE="word") for e in generate_entries(xml, FIELDS))
+    return [r for r in rows if r]
+
+def extractor(slice_bytes):
+    e = Extractor.__new__(Extractor)
+    e.EXTRACT = "body"
+    e.n = 2
+    e.MODE = "word"
+    e.KEEP_NUM = False
+    e.BATCH_SIZE = 1000
+    e.XML_SLICE_BYTES = slice_bytes
+    return e
+
+def sliced_rows(pool, fname, slice_bytes, slices=None):
+    if slices is None:
+        slices = find_xml_slices(fname, TAGS, slice_bytes)
+    if slices is None:
+        tasks = [(fname, None, None, None, None)]
+    else:
+        tasks = [(fname, None, start, end, header) for start, end, header in slices]
+    return [r for r in extractor(slice_bytes).parse_xml(pool, tasks, FIELDS, TAGS, KEYS) if r]
+
+if __name__ == "__main__":
+    num_records = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    rand = random.Random(42)
+    tmp = Path(tempfile.mkdtemp())
+
+    with closing(mp.Pool(max(1, Extract.NUM_PROC))) as pool:
+        # nested first field, quoted record tags, plain: sliced rows == whole-file rows, also with one (oversized) slice
+        for name, nested, quoted in [("nested", True, False), ("quoted", False, True), ("plain", False, False)]:
+            fname = (tmp / "{}.xml".format(name)).as_posix()
+            Path(fname).write_text(make_xml(rand, 3000, nested, quoted))
+            assert Extract.find_record_tag(open(fname, 'rb'), TAGS) == "rec"
+            for slice_bytes in [20000, 1 << 30]:
+                assert sliced_rows(pool, fname, slice_bytes) == whole_rows(fname), (name, slice_bytes)
+
+        # slice boundaries inside records: the rest of the file falls back to a whole parse
+        fname = (tmp / "nested.xml").as_posix()
+        bad = [(start, end, header) for start, end, header in find_xml_slices(fname, TAGS, 20000)]
+        bad = bad[:3] + [(bad[3][0] + 5, bad[3][1], bad[3][2])] + bad[4:]
+        assert sorted(sliced_rows(pool, fname, 20000, bad)) == sorted(whole_rows(fname))
+
+        fname = (tmp / "bench.xml").as_posix()
+        Path(fname).write_text(make_xml(rand, num_records))
+        start = time.perf_counter()
+        n = len(whole_rows(fname))
+        before = num_records / (time.perf_counter() - start)
+        start = time.perf_counter()
+        sliced_rows(pool, fname, 1 << 20)
+        after = num_records / (time.perf_counter() - start)
+        pool.close()
+        pool.join()
+    print("xml parsing: {:.0f} records/sec whole, {:.0f} records/sec sliced ({:.2f}x) on {} records, {} rows kept".format(
+        before, after, after / before, num_records, n))
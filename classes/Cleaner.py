@@ -0,0 +1,130 @@
+# Author: Stephen Meisenbacher
+# Cleaner.py
+# shared text cleaning for extraction and pdf-to-text, with all rules compiled once
+
+import re
+from html import unescape
+from bs4 import BeautifulSoup
+import decimal
+from functools import lru_cache
+from num2words import num2words
+
+DIGIT_CACHE_SIZE = 65536 # distinct numbers remembered per process
+
+######## COMPILED RULES #########
+WWW = re.compile(r"www\S+")
+SINGLE_LETTER = re.compile(r"\b[b-hj-zA-Z]\b") # any single letter word except 'a' and 'i'
+DIGITS = re.compile(r"\d+")
+HAS_DIGIT = re.compile(r"\d")
+NUMBER = re.compile(r"(\$?\d*[,\.]?\d+)")
+NON_TEXT = re.compile(r"[^0-9a-zA-Z\.\?\! ]+")
+DOTS = re.compile(r"\.{2,}")
+LETTER_DOT = re.compile(r"(?<!\w)([A-Za-z])\.")
+
+# markup
+TAG_START = re.compile(r"<[A-Za-z/!?]")
+INLINE_TAG = re.compile(r"</?(?:b|i|u|em|strong|span|a|br|sub|sup|font|small|big|mark|code|cite)(?:\s[^<>\"'&]*)?/?>", re.I)
+ODD_CHARS = re.compile(r"&[A-Za-z#]|[\x00-\x08\x0b-\x1f\x7f]") # entities / control chars: leave to the parser
+##################################
+
+# drop html tags: plain inline markup is stripped directly, anything else goes through BeautifulSoup
+def strip_tags(text):
+    if not text[:1].isspace() and ODD_CHARS.search(text) is None:
+        if TAG_START.search(text) is None:
+            return text # stray '<' only, nothing to parse
+        segments = INLINE_TAG.split(text)
+        tags = len(segments) - 1
+        if text[0] != '<' and len(TAG_START.findall(text)) == tags and not any(s.isspace() for s in segments):
+            return "".join(segments)
+    return BeautifulSoup(text, "lxml").text
+
+def strip_markup(text):
+    if '&' in text:
+        text = unescape(text.strip()) # remove html chars
+    if '<' in text:
+        text = strip_tags(text)
+    return text
+
+# corpora repeat the same numbers over and over, so num2words results are memoized
+@lru_cache(maxsize=DIGIT_CACHE_SIZE)
+def digit_switch(x):
+    try:
+        if '$' in x:
+            return num2words(x.replace('$', '').replace(',',''), to="currency", lang='en_US').replace("euro", "dollars")
+        elif x.count('.') > 1:
+            return '.'.join([num2words(z, to="cardinal") if z != ""  else "" for z in x.split('.')])
+        elif "." in x:
+            return num2words(x, to="cardinal")
+        elif len(x) == 4:
+            return num2words(x, to="year")
+        else:
+            return num2words(x, to="cardinal")
+    except decimal.InvalidOperation:
+        return " "
+
+def handle_digits(text):
+    if HAS_DIGIT.search(text) is None:
+        return text
+    else:
+        text = text.split()
+        temp = []
+        for x in text:
+            # isdigit() also covers non-ascii digits the regex does not
+            if HAS_DIGIT.search(x) is not None or (not x.isascii() and any(c.isdigit() for c in x)):
+                to_convert = [y for y in NUMBER.split(x) if HAS_DIGIT.search(y) is not None]
+
+                for t in to_convert:
+                    x = x.replace(t, digit_switch(t))
+
+                if '%' in x:
+                    x = x.replace('%', ' percent')
+
+                temp.append(x)
+            else:
+                temp.append(x)
+
+        return " ".join(temp)
+
+# cleaning for keyword extraction
+def clean(text, KEEP_NUM=False):
+    text = strip_markup(text)
+    text = WWW.sub(" ", text)
+    text = SINGLE_LETTER.sub(" ", text)
+
+    if KEEP_NUM == True:
+        text = handle_digits(text)
+    else:
+        text = DIGITS.sub(" ", text)
+
+    # plain str.replace is faster here than a translate table or a combined regex
+    text = text.replace(',','') # remove commas for easier csv readability
+    text = text.replace(':','.').replace('*','.')
+    text = text.replace(' .', '.')
+    text = text.encode("ascii", "ignore").decode()
+    # keyword specfic
+    text = text.replace("-site", "site").replace(" site", "site")
+    text = text.replace("-life", "life").replace(" life", "life")
+
+    text = text.replace(" s "," ")
+
+    return text
+
+# cleaning for plain text output (pdf-to-text)
+def clean_text(text, ABBREV):
+    text = strip_markup(text)
+    text = WWW.sub(" ", text)
+    text = SINGLE_LETTER.sub(" ", text)
+    text = DIGITS.sub(" ", text)
+    text = text.encode("ascii", "ignore").decode()
+    text = NON_TEXT.sub(" ", text) # also covers ',', ':' and '*'
+    text = " ".join(text.split())
+    text = text.replace(" .", ".")
+    text = DOTS.sub(".", text)
+
+    # handle abbreviations
+    text = " ".join([ABBREV.get(x.lower(), x) for x in text.split()])
+    text = LETTER_DOT.sub(r"\1", text)
+
+    text = text.lower()
+
+    return text
@@ -0,0 +1,78 @@
+# Author: Stephen Meisenbacher
+# DBWriter.py
+# bulk sqlite sink for the dataset pipeline: WAL journal, large explicit transactions, prepared executemany inserts
+
+import sqlite3
+import time
+import logging
+import pandas as pd
+
+PRAGMAS = {
+    "journal_mode":"WAL",
+    "synchronous":"NORMAL", # safe with WAL, only the last transactions can be lost on power failure
+    "cache_size":-262144, # KiB (256 MB)
+    "mmap_size":1073741824, # bytes (1 GB)
+    "temp_store":"MEMORY",
+}
+BATCH_ROWS = 50000 # rows per executemany call
+
+# a column as plain python values sqlite can bind, None (NULL) for missing values
+def to_values(col):
+    if pd.api.types.is_datetime64_any_dtype(col):
+        col = col.dt.strftime("%Y-%m-%d %H:%M:%S")
+    if col.isna().any():
+        return col.astype(object).where(col.notna(), None).tolist()
+    return col.tolist()
+
+class DBWriter:
+    con = None
+    table = None
+    PRAGMAS = PRAGMAS
+    BATCH_ROWS = BATCH_ROWS
+
+    # throughput counters
+    rows = 0
+    seconds = 0
+
+    def __init__(self, db_path, table, PRAGMAS=PRAGMAS, BATCH_ROWS=BATCH_ROWS):
+        self.table = table
+        self.PRAGMAS = PRAGMAS
+        self.BATCH_ROWS = BATCH_ROWS
+        self.con = sqlite3.connect(db_path, isolation_level=None) # transactions are begun / committed explicitly
+        for k, v in self.PRAGMAS.items():
+            self.con.execute("PRAGMA {}={}".format(k, v))
+
+    # insert the rows of df (index included, as its first column) in one transaction;
+    # rows with an already stored primary key are skipped
+    def write(self, df):
+        start = time.time()
+        df = df.reset_index()
+        columns = ", ".join('"{}"'.format(c) for c in df.columns)
+        insert = 'INSERT OR IGNORE INTO "{}" ({}) VALUES ({})'.format(self.table, columns, ", ".join("?" for _ in df.columns))
+
+        values = list(zip(*[to_values(df[c]) for c in df.columns]))
+        self.con.execute("BEGIN")
+        try:
+            for b in range(0, len(values), self.BATCH_ROWS):
+                self.con.executemany(insert, values[b:b+self.BATCH_ROWS])
+            self.con.execute("COMMIT")
+        except Exception:
+            self.con.execute("ROLLBACK")
+            raise
+
+        self.rows += len(df.index)
+        self.seconds += time.time() - start
+        logging.getLogger("messages").info("DBWRITER: {} rows stored ({:.0f} rows/sec)".format(len(df.index), self.throughput()))
+
+    def throughput(self):
+        return self.rows / self.seconds if self.seconds > 0 else 0
+
+    # after the last write: secondary indexes (built once, instead of maintained on every insert), then close
+    def finish(self, index_columns=[]):
+        start = time.time()
+        for c in index_columns:
+            self.con.execute('CREATE INDEX IF NOT EXISTS "{}_{}" ON "{}" ("{}")'.format(self.table, c, self.table, c))
+        self.con.execute("PRAGMA wal_checkpoint(TRUNCATE)") # everything into the main db file
+        self.con.close()
+        logging.getLogger("messages").info("DBWRITER: {} rows in total ({:.0f} rows/sec), {} index(es) built in {:.1f}s".format(
+            self.rows, self.throughput(), len(index_columns), time.time() - start))
@@ -0,0 +1,175 @@
+# Author: Stephen Meisenbacher
+# EmbedCache.py
+# on-disk sentence embedding store: every text is encoded once per model, across classes and runs
+
+import os
+import time
+import hashlib
+import numpy as np
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+# advisory file locks, so that concurrent extractions can share one store (not available on windows)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+KEY_SIZE = 16 # bytes per text hash
+DTYPE = "float32" # "float16" halves the store, at some precision
+BATCH_SIZE = 256 # texts per model.encode call
+THREADS = 1 # concurrent model.encode calls (the model itself also runs multithreaded)
+
+# hash of the text and the model that encodes it
+def text_key(text, model_name):
+    return hashlib.blake2b("{}\x00{}".format(model_name, text).encode("utf-8"), digest_size=KEY_SIZE).digest()
+
+# embeddings of texts, in input order: texts are encoded in length-sorted batches, so little padding is wasted
+def encode_batched(model, texts, dim, BATCH_SIZE=BATCH_SIZE, THREADS=THREADS):
+    order = np.argsort(np.fromiter((len(t) for t in texts), dtype=np.int64, count=len(texts)), kind="stable")
+    batches = [order[i:i+BATCH_SIZE] for i in range(0, len(order), BATCH_SIZE)]
+
+    def encode(batch):
+        return batch, model.encode([texts[i] for i in batch], batch_size=len(batch))
+
+    out = np.zeros((len(texts), dim), dtype=np.float32)
+    if THREADS > 1 and len(batches) > 1:
+        with ThreadPoolExecutor(THREADS) as executor:
+            for batch, vectors in executor.map(encode, batches):
+                out[batch] = vectors
+    else:
+        for batch in batches:
+            out[batch] = encode(batch)[1]
+    return out
+
+# rows scaled to unit length, so that cosine similarity is a plain matrix product
+def unit_rows(m):
+    m = np.asarray(m, dtype=np.float32)
+    norm = np.linalg.norm(m, axis=-1, keepdims=True)
+    return m / np.where(norm == 0, 1, norm)
+
+# store layout (per model and dtype): index.bin holds the text hashes, vectors.bin the matching rows
+# rows are only ever appended: vectors first, then their hashes, so a row is valid once its hash is written
+class EmbeddingCache:
+    path = None
+    model = None
+    model_name = None
+    DTYPE = DTYPE
+    dim = None
+    rows = 0
+    index = None # text hash -> row
+    vectors = None # memory-mapped (rows, dim) matrix
+
+    BATCH_SIZE = BATCH_SIZE
+    THREADS = THREADS
+
+    # counters, for throughput reporting
+    hits = 0
+    misses = 0
+    encode_time = 0
+
+    def __init__(self, path, model, model_name, DTYPE=DTYPE, BATCH_SIZE=BATCH_SIZE, THREADS=THREADS):
+        self.model = model
+        self.model_name = model_name
+        self.DTYPE = np.dtype(DTYPE)
+        self.BATCH_SIZE = BATCH_SIZE
+        self.THREADS = THREADS
+        self.dim = model.get_sentence_embedding_dimension()
+        self.path = Path(path) / model_name.replace('/', '_') / self.DTYPE.name
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        self.index = {}
+        self.rows = 0
+        with self.locked():
+            self.refresh(repair=True)
+
+    def index_file(self):
+        return self.path / "index.bin"
+
+    def vector_file(self):
+        return self.path / "vectors.bin"
+
+    def locked(self):
+        return StoreLock(self.path / "store.lock")
+
+    # pick up rows appended since the last look (by this or another process)
+    # repair: drop a partly written tail left behind by an interrupted run
+    def refresh(self, repair=False):
+        row_size = self.dim * self.DTYPE.itemsize
+        n_keys = self.index_file().stat().st_size // KEY_SIZE if self.index_file().exists() else 0
+        n_vectors = self.vector_file().stat().st_size // row_size if self.vector_file().exists() else 0
+        n = min(n_keys, n_vectors)
+
+        if repair == True:
+            for f, size in [(self.index_file(), n * KEY_SIZE), (self.vector_file(), n * row_size)]:
+                if f.exists() and f.stat().st_size != size:
+                    os.truncate(f.as_posix(), size)
+
+        if n > self.rows:
+            with open(self.index_file(), "rb") as f:
+                f.seek(self.rows * KEY_SIZE)
+                keys = f.read((n - self.rows) * KEY_SIZE)
+            for i in range(n - self.rows):
+                self.index.setdefault(keys[i*KEY_SIZE:(i+1)*KEY_SIZE], self.rows + i)
+            self.rows = n
+        self.vectors = np.memmap(self.vector_file(), dtype=self.DTYPE, mode="r", shape=(self.rows, self.dim)) if self.rows > 0 else None
+
+    # embeddings of all texts, (len(texts), dim) float32; texts not in the store yet are encoded once and added
+    def encode(self, texts):
+        if len(texts) == 0:
+            return np.zeros((0, self.dim), dtype=np.float32)
+
+        keys = [text_key(t, self.model_name) for t in texts]
+        self.fill_keys(keys, texts)
+        rows = np.fromiter((self.index[k] for k in keys), dtype=np.int64, count=len(keys))
+        return np.asarray(self.vectors[rows], dtype=np.float32)
+
+    # only make sure all texts are in the store (e.g. ahead of time, for many files at once)
+    def fill(self, texts):
+        self.fill_keys([text_key(t, self.model_name) for t in texts], texts)
+
+    def fill_keys(self, keys, texts):
+        missing = {}
+        for k, t in zip(keys, texts):
+            if k not in self.index and k not in missing:
+                missing[k] = t
+        self.misses += len(missing)
+        self.hits += len(texts) - len(missing)
+
+        if len(missing) > 0:
+            start = time.time()
+            new = encode_batched(self.model, list(missing.values()), self.dim, BATCH_SIZE=self.BATCH_SIZE, THREADS=self.THREADS)
+            self.encode_time += time.time() - start
+            self.add(list(missing.keys()), new.astype(self.DTYPE))
+
+    # encoded texts per second so far
+    def throughput(self):
+        return self.misses / self.encode_time if self.encode_time > 0 else 0
+
+    def add(self, keys, vectors):
+        with self.locked():
+            self.refresh() # another process may have added some of these meanwhile
+            keep = [i for i, k in enumerate(keys) if k not in self.index]
+            if len(keep) == 0:
+                return
+            with open(self.vector_file(), "ab") as f:
+                f.write(np.ascontiguousarray(vectors[keep]).tobytes())
+            with open(self.index_file(), "ab") as f:
+                f.write(b"".join(keys[i] for i in keep))
+            self.refresh()
+
+# exclusive lock on the store while it is read or appended to
+class StoreLock:
+    def __init__(self, fname):
+        self.fname = fname
+
+    def __enter__(self):
+        self.f = open(self.fname, "a")
+        if fcntl is not None:
+            fcntl.flock(self.f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        if fcntl is not None:
+            fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
@@ -11,15 +11,18 @@ import re
 import pandas as pd
 import numpy as np
 from lxml import etree
-from html import unescape
-from bs4 import BeautifulSoup
 import csv
 import nltk
 nltk.download("punkt", quiet=True)
 from nltk.tokenize import word_tokenize, sent_tokenize
 import logging
 import math
-import decimal
+import json
+import hashlib
+import shutil
+import io
+import mmap
+import tempfile
 
 import zipfile
 from pathlib import Path
@@ -29,77 +32,17 @@ else:
     import multiprocess as mp
 from contextlib import closing
 from functools import partial
-from num2words import num2words
+from itertools import islice
 
 sys.path.append("../views")
 from views.utility import get_mongo_client
+from Matcher import get_matcher
+from Cleaner import clean, digit_switch
+from Reader import read_csv_chunks, read_shard, open_shard_writer, write_shard_batch, CHUNK_SIZE
+from EmbedCache import StoreLock
 
 NUM_PROC = int(0.75 * mp.cpu_count())
 
-def digit_switch(x):
-    try:
-        if '$' in x:
-            return num2words(x.replace('$', '').replace(',',''), to="currency", lang='en_US').replace("euro", "dollars")
-        elif x.count('.') > 1:
-            return '.'.join([num2words(z, to="cardinal") if z != ""  else "" for z in x.split('.')])
-        elif "." in x:
-            return num2words(x, to="cardinal")
-        elif len(x) == 4:
-            return num2words(x, to="year")
-        else:
-            return num2words(x, to="cardinal")
-    except decimal.InvalidOperation:
-        return " "
-
-def handle_digits(text):
-    if not re.search('\d+', text):
-        return text
-    else:
-        text = text.split()
-        temp = []
-        for x in text:            
-            if any(c.isdigit() for c in x):
-                to_convert = [y for y in re.split("(\$?\d*[,\.]?\d+)", x) if re.search('\d+', y)]
-                
-                for t in to_convert:
-                    x = x.replace(t, digit_switch(t))
-                    
-                if '%' in x:
-                    x = x.replace('%', ' percent')
-                    
-                temp.append(x)
-            else:
-                temp.append(x)
-                
-        return " ".join(temp)
-
-# utility for quick cleaning text
-def clean(text, KEEP_NUM=False):
-    if '&' in text:
-        text = unescape(text.strip()) # remove html chars
-    if '<' in text:
-        text = BeautifulSoup(text, "lxml").text
-    text = re.sub(r"www\S+", " ", text)
-    text = re.sub(r"\b(?![ai])[a-zA-Z]\b", " ", text)
-
-    if KEEP_NUM == True:
-        text = handle_digits(text)
-    else:
-        text = re.sub(r"\d+", " ", text)
-
-    #text = " ".join(text.split()) # remove excess newlines
-    text = text.replace(',','') # remove commas for easier csv readability
-    text = text.replace(':','.').replace('*','.')
-    text = text.replace(' .', '.')
-    text = text.encode("ascii", "ignore").decode()
-    # keyword specfic
-    text = text.replace("-site", "site").replace(" site", "site")
-    text = text.replace("-life", "life").replace(" life", "life")
-
-    text = text.replace(" s "," ")
-
-    return text
-
 # generator to feed the pool workers xml entries
 def generate_entries(xml, fields):
     xmls = [xml for _ in fields]
@@ -109,7 +52,204 @@ def generate_entries(xml, fields):
         for z in tup:
             z[1].clear()
 
-def get_context(text, keywords, n, MODE="word"):
+# filter records chunk by chunk: the next chunk is queued while the current one is drained,
+# so at most two chunks are in flight (imap would otherwise pull the whole input at once)
+def feed_chunks(pool, func, chunks):
+    pending = None
+    for records in chunks:
+        current = pool.imap_unordered(func, records, chunksize=10)
+        if pending is not None:
+            yield from pending
+        pending = current
+    if pending is not None:
+        yield from pending
+
+def file_records(data, to_change, sub_parent, fields):
+    if sub_parent is not None:
+        data['parent'] = sub_parent
+    data = data.rename(columns={to_change:"filename"})
+    data['filename'] = data['filename'].fillna("")
+    return data[fields].to_dict('records')
+
+# the innermost element enclosing every field, i.e. one record (None if the fields sit directly under the root)
+# taken from the paths of the first occurrence of each field, so fields may be nested inside the record
+def find_record_tag(f, tags):
+    paths = {}
+    stack = []
+    for event, elem in etree.iterparse(f, events=('start', 'end')):
+        if event == 'start':
+            if elem.tag in tags and elem.tag not in paths:
+                paths[elem.tag] = list(stack)
+                if len(paths) == len(set(tags)):
+                    break
+            stack.append(elem.tag)
+        else:
+            stack.pop()
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+    if len(paths) == 0:
+        return None
+
+    common = []
+    for level in zip(*paths.values()):
+        if any(t != level[0] for t in level):
+            break
+        common.append(level[0])
+    if len(common) < 2 or any(not isinstance(t, str) or '{' in t for t in common) or common.count(common[-1]) > 1:
+        return None
+    return common[-1]
+
+# split an xml file into byte ranges of whole records, found with a plain byte scan
+# returns [(start, end, header)], or None if the file cannot be split safely (namespaces, DTD, no records) or needs no split
+def find_xml_slices(fname, tags, slice_bytes):
+    if os.path.getsize(fname) <= slice_bytes:
+        return None # a single slice: parsed whole
+    with open(fname, 'rb') as f:
+        record = find_record_tag(f, tags)
+    if record is None:
+        return None
+    record = record.encode()
+
+    with open(fname, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            root = re.compile(rb"<[^?!]").search(mm)
+            if root is None:
+                return None
+            prolog = mm[:root.start()]
+            if b"<!DOCTYPE" in prolog or b"xmlns" in mm[root.start():mm.find(b">", root.start())]:
+                return None
+            header = prolog[:prolog.find(b"?>")+2] if prolog.startswith(b"<?xml") else b""
+
+            start_tag = re.compile(rb"<" + re.escape(record) + rb"[\s>/]")
+            end = mm.rfind(b"</" + record + b">")
+            if end == -1:
+                return None
+            end += len(record) + 3
+
+            # a record tag inside a CDATA section or comment is not a boundary
+            # sections are found in one forward scan, as the candidate boundaries advance
+            openers = {o:mm.find(o) for o, c in [(b"<![CDATA[", b"]]>"), (b"<!--", b"-->")]}
+            closers = {b"<![CDATA[":b"]]>", b"<!--":b"-->"}
+            none_left = (len(mm) + 1, len(mm) + 1)
+
+            # (start, end) of the first quoted section starting at or after pos (end: past its closer)
+            def next_section(pos):
+                for o in openers:
+                    if openers[o] != -1 and openers[o] < pos:
+                        openers[o] = mm.find(o, pos)
+                found = [(p, o) for o, p in openers.items() if p != -1]
+                if len(found) == 0:
+                    return none_left
+                p, o = min(found)
+                close = mm.find(closers[o], p + len(o))
+                return (p, close + len(closers[o]) if close != -1 else len(mm) + 1)
+
+            section = next_section(0)
+            parts = max(1, math.ceil(len(mm) / slice_bytes))
+            starts = []
+            for k in range(parts):
+                pos = max(k * len(mm) // parts, starts[-1] if len(starts) > 0 else 0) # candidates only move forward
+                while True:
+                    m = start_tag.search(mm, pos)
+                    if m is None:
+                        break
+                    while section[1] <= m.start():
+                        section = next_section(section[1])
+                    if section[0] >= m.start():
+                        break
+                    if section[1] > len(mm):
+                        m = None # unterminated section, no further boundaries
+                        break
+                    pos = section[1]
+                if m is None or m.start() >= end:
+                    break
+                if len(starts) == 0 or starts[-1] != m.start():
+                    starts.append(m.start())
+    if len(starts) == 0:
+        return None
+    return [(a, b, header) for a, b in zip(starts, starts[1:] + [end])]
+
+# worker: parse and filter one slice of an xml input, returns (number of entries, rows)
+# a slice is a byte range of whole records (wrapped in a dummy root), a whole file, or a whole zip member
+# None for a byte range that does not parse (its boundaries were not record boundaries after all)
+def parse_xml_slice(task, fields=None, tags=None, KEYS=None, n=None, MODE=None, KEEP_NUM=False, FILTER=True):
+    try:
+        return read_xml_slice(task, fields, tags, KEYS, n, MODE, KEEP_NUM, FILTER)
+    except etree.XMLSyntaxError as e:
+        if task[2] is not None:
+            return None
+        raise ValueError("{}: {}".format(task[1] if task[1] is not None else task[0], e)) # lxml errors do not pickle
+
+def read_xml_slice(task, fields, tags, KEYS, n, MODE, KEEP_NUM, FILTER):
+    fname, member, start, end, header = task
+    if member is not None:
+        with zipfile.ZipFile(fname, 'r') as z:
+            with z.open(member) as f:
+                return xml_rows(f, fields, tags, KEYS, n, MODE, KEEP_NUM, FILTER)
+    with open(fname, 'rb') as f:
+        if start is None:
+            return xml_rows(f, fields, tags, KEYS, n, MODE, KEEP_NUM, FILTER)
+        f.seek(start)
+        data = io.BytesIO(header + b"<craml_slice>" + f.read(end - start) + b"</craml_slice>")
+    return xml_rows(data, fields, tags, KEYS, n, MODE, KEEP_NUM, FILTER)
+
+# entries of a whole xml file or zip member, in batches of size (parsed here, filtered by the caller)
+# skip: entries already produced elsewhere (e.g. by the slices before a failed one)
+def xml_entry_batches(task, fields, tags, size, skip=0):
+    fname, member = task[0], task[1]
+    try:
+        if member is not None:
+            with zipfile.ZipFile(fname, 'r') as z:
+                with z.open(member) as f:
+                    yield from entry_batches(etree.iterparse(f, events=('end',), tag=tags), fields, size, skip)
+        else:
+            with open(fname, 'rb') as f:
+                yield from entry_batches(etree.iterparse(f, events=('end',), tag=tags), fields, size, skip)
+    except etree.XMLSyntaxError as e:
+        raise ValueError("{}: {}".format(member if member is not None else fname, e))
+
+def entry_batches(xml, fields, size, skip=0):
+    entries = islice(generate_entries(xml, fields), skip, None)
+    while True:
+        batch = list(islice(entries, size))
+        if len(batch) == 0:
+            break
+        yield batch
+
+# bytes a worker would parse for a task
+def task_bytes(task):
+    fname, member, start, end, header = task
+    if member is not None:
+        with zipfile.ZipFile(fname, 'r') as z:
+            return z.getinfo(member).file_size
+    if start is None:
+        return os.path.getsize(fname)
+    return end - start
+
+def entry_values(entry):
+    return tuple(entry.values())
+
+def xml_rows(f, fields, tags, KEYS, n, MODE, KEEP_NUM, FILTER):
+    xml = etree.iterparse(f, events=('end',), tag=tags)
+    count = 0
+    rows = []
+    for e in generate_entries(xml, fields):
+        count += 1
+        r = filter_data(e, KEYS=KEYS, n=n, MODE=MODE, KEEP_NUM=KEEP_NUM) if FILTER == True else tuple(e.values())
+        if r:
+            rows.append(r)
+    return count, rows
+
+# the keyword automata a worker filters with: (raw keywords, stripped keywords for the context search,
+# the characters of all keywords - the cleaned text is kept if it has any of them, as before the automata)
+# KEYS None: the pool's keywords, built once in init_pool; otherwise other keys (e.g. only newly added keywords)
+def keyword_matchers(KEYS):
+    if KEYS is None:
+        return global_matchers
+    return get_matcher(KEYS), get_matcher([k.strip() for k in KEYS]), frozenset("".join(KEYS))
+
+def get_context(text, context_matcher, n, MODE="word"):
     #n = 6
     if MODE == "word":
         text = re.sub(r'[^a-z0-9]+', ' ', text)
@@ -128,17 +268,12 @@ def get_context(text, keywords, n, MODE="word"):
         #words = sent_tokenize(text)
         words = [x.strip() for x in text.split('.')]
         
-    found_index = [i for i, w in enumerate(words) if any(k.strip() in w for k in keywords)]
+    # one automaton pass over all words, rather than every keyword against every word
+    found_index = context_matcher.find_units(words)
     context = [" ".join(words[max(0, idx-n):min(idx+n+1, len(words))]) for idx in found_index]
 
     return '|'.join(context)
 
-def _filter_helper_(arg):
-    if any(a in arg[0] for a in arg[1]):
-        return True
-    else:
-        return False
-
 # filter the provided xml entries
 # if the text contains keywords, find all sentences that do
 def filter_data(entry, parent=None, sub_parent=None, KEYS=None, n=None, MODE=None, KEEP_NUM=False):
@@ -187,34 +322,36 @@ def filter_data(entry, parent=None, sub_parent=None, KEYS=None, n=None, MODE=Non
         return None
 
     #keywords = global_keywords
-    keywords = KEYS
-    if any(w in text for w in keywords):
+    matcher, context_matcher, chars = keyword_matchers(KEYS)
+    if matcher.search(text):
         # first roughly clean text
         text = clean(text, KEEP_NUM)
 
         keep = []
         text = text.lower()
-        args = ((text, k) for k in keywords)
-        res = set(map(_filter_helper_, args))
-        if True in res:
-            context = get_context(text, keywords, n, MODE)
+        if not chars.isdisjoint(text):
+            context = get_context(text, context_matcher, n, MODE)
             keep.append(context)
 
         keep = list(set(keep)) # remove duplicates
+        # plain tuple, in output column order - pickles cheaply and needs no splitting in the parent
         if parent is not None:
-            return ":::".join([str(entry[x]) for x in entry.keys() if x != "filename"]+["|".join(keep)])
+            return tuple(str(entry[x]) for x in entry.keys() if x != "filename") + ("|".join(keep),)
         else:
-            return ":::".join([str(entry[x]) for x in entry.keys() if x != "text"]+["|".join(keep)])
+            return tuple(str(entry[x]) for x in entry.keys() if x != "text") + ("|".join(keep),)
     else:
         return None
 
-# utility for creating pandas df
-def split_and_dict(rows, fields):
-    to_df = []
-    for r in rows:
-        splitted = r.split(':::')
-        to_df.append({fields[i]:x for i, x in enumerate(splitted)})
-    return to_df
+# write one batch of filtered rows (new file with header, or append)
+def write_batch(rows, fields, save_name, header=True, writer=None):
+    df = pd.DataFrame.from_records(rows, columns=fields)
+    df = df.replace("", np.nan)
+    df = df.dropna()
+    if writer is not None:
+        write_shard_batch(df, writer)
+    else:
+        df.to_csv(save_name, index=False, quoting=0, mode="w" if header == True else "a", header=header)
+    return len(df.index)
 
 # for merging with new keywords
 def merge_helper(row):
@@ -226,16 +363,88 @@ def merge_helper(row):
         else:
             return row['text1'] + '|' + row['text2']
 
+# split a collection into _id ranges, using quantiles of a random sample of ids as boundaries
+def get_id_ranges(collection, parts, samples=20):
+    total = collection.estimated_document_count()
+    if total == 0 or parts <= 1:
+        return [(None, None)]
+
+    size = min(total, parts * samples)
+    sampled = collection.aggregate([{"$sample":{"size":size}}, {"$project":{"_id":1}}])
+    try:
+        ids = sorted(d['_id'] for d in sampled)
+    except TypeError:
+        return [(None, None)] # mixed _id types, no ordering to split on
+
+    bounds = []
+    for i in range(1, parts):
+        b = ids[int(i * len(ids) / parts)]
+        if len(bounds) == 0 or bounds[-1] != b:
+            bounds.append(b)
+    edges = [None] + bounds + [None]
+    return list(zip(edges[:-1], edges[1:]))
+
+def range_query(lower, upper):
+    query = {}
+    if lower is not None:
+        query["$gte"] = lower
+    if upper is not None:
+        query["$lt"] = upper
+    return {"_id":query} if len(query) > 0 else {}
+
+# merge the chunks for newly added keywords into a previous shard (result written to new_shard)
+def merge_shards(old_shard, new_shard):
+    old = read_shard(old_shard, dtype=str)
+    new = read_shard(new_shard, dtype=str)
+    on = [c for c in old.columns if c != "text"]
+
+    merged = old.rename(columns={"text":"text1"}).merge(new.rename(columns={"text":"text2"}), on=on, how="outer")
+    merged[["text1", "text2"]] = merged[["text1", "text2"]].fillna("empty")
+    merged["text"] = merged.apply(merge_helper, axis=1)
+    merged = merged.drop(columns=["text1", "text2"])
+    if Path(new_shard).suffix == ".parquet":
+        writer = open_shard_writer(new_shard, merged.columns.tolist())
+        write_shard_batch(merged, writer)
+        writer.close()
+    else:
+        merged.to_csv(new_shard, index=False, quoting=0)
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(partial(f.read, 1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def keyword_hash(keywords):
+    return hashlib.sha1("\n".join(sorted(set(keywords))).encode()).hexdigest()
+
+# add this worker's number cache counts to the shared totals (on worker exit)
+def report_cache_stats(stats):
+    info = digit_switch.cache_info()
+    with stats.get_lock():
+        stats[0] += info.hits
+        stats[1] += info.misses
+
 # for global keyword access
-def init_pool(k, m, n):
+def init_pool(k, m, n, stats=None):
     global global_keywords
     global global_mode
     global global_n
+    global global_matchers
 
     global_keywords = k
     global_mode = m
     global_n = n
 
+    if stats is not None:
+        digit_switch.cache_clear() # count this worker's lookups only
+        mp.util.Finalize(None, report_cache_stats, args=(stats,), exitpriority=10)
+
+    # compile the keyword automata once per worker
+    if k is not None:
+        global_matchers = keyword_matchers(k)
+
 class Extract:
     keywords = None
     filelist = None
@@ -246,13 +455,34 @@ class Extract:
     EXTRACT = None
     FILE_EXTRACT = None
     KEEP_NUM = False
-
-    def __init__(self, ext_list, csv_dir, fields, n, KEYS=None, SETTINGS=None, MODE="Word", FILE_EXT=False, KEEP_NUM=False):
+    BATCH_SIZE = 10000 # rows held in memory before appending to output (None: whole file)
+    ROWS_PER_SHARD = 1000000 # rows per output file for database extraction
+    SHARD_FILES = False # file inputs are split every ROWS_PER_SHARD rows as well (bounded shards for streaming consumers)
+    manifest = None
+    PARTITIONS = None # _id ranges for database extraction (default: 4 per process)
+    XML_SLICE_BYTES = 16*1024*1024 # target size of one xml slice handed to a worker
+    CHUNK_SIZE = CHUNK_SIZE # rows per chunk of delimited input
+    CSV_ENGINE = None # "pyarrow" for the pyarrow reader, if installed
+    SHARD_FORMAT = "csv" # or "parquet" (columnar, needs pyarrow)
+
+    def __init__(self, ext_list, csv_dir, fields, n, KEYS=None, SETTINGS=None, MODE="Word", FILE_EXT=False, KEEP_NUM=False,
+                    BATCH_SIZE=10000, ROWS_PER_SHARD=1000000, MANIFEST=None, PARTITIONS=None, MONGO_CLIENT=get_mongo_client,
+                    XML_SLICE_BYTES=16*1024*1024, CHUNK_SIZE=CHUNK_SIZE, CSV_ENGINE=None, SHARD_FORMAT="csv", SHARD_FILES=False):
 
         self.MODE = MODE
         self.n = n
         self.FILE_EXTRACT = FILE_EXT
         self.KEEP_NUM = KEEP_NUM
+        self.BATCH_SIZE = BATCH_SIZE
+        self.ROWS_PER_SHARD = ROWS_PER_SHARD
+        self.SHARD_FILES = SHARD_FILES
+        self.manifest = Path(MANIFEST) if MANIFEST is not None else None # incremental mode
+        self.PARTITIONS = PARTITIONS
+        self.XML_SLICE_BYTES = XML_SLICE_BYTES
+        self.CHUNK_SIZE = CHUNK_SIZE
+        self.CSV_ENGINE = CSV_ENGINE
+        self.SHARD_FORMAT = SHARD_FORMAT
+        self.mongo_client = MONGO_CLIENT # client factory, called once per worker
 
         # read in keywords (search terms)
         self.keywords = KEYS
@@ -281,6 +511,66 @@ class Extract:
 
         logging.getLogger("messages").info("EXTRACT: init complete, extract: {}, mode: {}, file_extract: {}".format(self.EXTRACT, self.MODE, self.FILE_EXTRACT))
 
+    # manifest: input file -> (size, mtime, content hash, keywords, settings) and the shard(s) it produced
+    def load_manifest(self):
+        if self.manifest is not None and self.manifest.is_file():
+            with open(self.manifest.as_posix(), 'r') as f:
+                return json.load(f)
+        return {}
+
+    def check_manifest(self, fname, fields):
+        stat = os.stat(fname)
+        entry = self.load_manifest().get(Path(fname).as_posix())
+
+        # only re-hash the file when size or mtime moved
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            content = entry['hash']
+        else:
+            content = file_hash(fname)
+
+        sig = {"size":stat.st_size, "mtime":stat.st_mtime, "hash":content, "keywords":sorted(set(self.keywords)),
+                "keyword_hash":keyword_hash(self.keywords), "n":self.n, "mode":self.MODE, "keep_num":self.KEEP_NUM,
+                "file_extract":self.FILE_EXTRACT, "fields":fields, "format":self.SHARD_FORMAT, "shard_files":self.SHARD_FILES}
+
+        if entry is None or any(entry.get(k, "csv") != sig[k] for k in ["hash", "n", "mode", "keep_num", "file_extract", "fields", "format"]) or \
+                entry.get("shard_files", False) != sig["shard_files"] or any(Path(s).is_file() == False for s in entry['shards']):
+            return "changed", entry, sig
+        elif entry['keyword_hash'] == sig['keyword_hash']:
+            return "unchanged", entry, sig
+        elif set(entry['keywords']).issubset(sig['keywords']) and self.SHARD_FILES == False:
+            # (new chunks are merged into the shard of the same name, which needs one shard per input)
+            return "new_keys", entry, sig
+        else:
+            return "changed", entry, sig
+
+    # read-modify-write under a file lock, so that concurrent extractions on one project keep each other's entries
+    def update_manifest(self, fname, sig, shards):
+        with StoreLock(self.manifest.with_suffix(".lock")):
+            manifest = self.load_manifest()
+            manifest[Path(fname).as_posix()] = {**sig, "shards":[Path(s).as_posix() for s in shards]}
+            with tempfile.NamedTemporaryFile('w', dir=self.manifest.parent, suffix=".tmp", delete=False) as out:
+                json.dump(manifest, out, indent=3)
+            os.replace(out.name, self.manifest.as_posix())
+
+    # previous shard with the same name as a newly written one
+    def find_shard(self, entry, shard):
+        for s in entry['shards']:
+            if Path(s).name == Path(shard).name:
+                return s
+        return None
+
+    # link (or copy) previous shards into this run's directory
+    def reuse_shards(self, entry):
+        reused = []
+        for s in entry['shards']:
+            save_name = self.csv_dir / Path(s).name
+            try:
+                os.link(s, save_name)
+            except OSError:
+                shutil.copyfile(s, save_name)
+            reused.append(save_name)
+        return reused
+
     def set_path(self, pid):
         self.csv_dir = Path(self.csv_dir) / pid
 
@@ -296,9 +586,157 @@ class Extract:
             text = ""
         return text
 
-    def extract(self):
+    # append filtered rows to csv as they arrive, in batches of BATCH_SIZE rows
+    # with SHARD, a new file is started every ROWS_PER_SHARD rows
+    def save_rows(self, rows, fields, stem, SHARD=False):
+        return list(self.iter_save_rows(rows, fields, stem, SHARD))
+
+    # as save_rows, but every file is yielded as soon as it is complete
+    def iter_save_rows(self, rows, fields, stem, SHARD=False):
         saved = []
-        with closing(mp.Pool(NUM_PROC, init_pool(self.keywords, self.MODE, self.n))) as pool:
+        batch = []
+        save_name = None
+        writer = None
+        shard_rows = 0
+        total = 0
+        suffix = ".parquet" if self.SHARD_FORMAT == "parquet" else ".csv"
+        for row in rows:
+            if not row:
+                continue # remove entries where nothing was found
+            batch.append(row)
+            if (self.BATCH_SIZE is not None and len(batch) >= self.BATCH_SIZE) or \
+                    (SHARD == True and shard_rows + len(batch) >= self.ROWS_PER_SHARD):
+                if save_name is None:
+                    save_name = self.csv_dir / ("{}_{}{}".format(stem, len(saved), suffix) if SHARD == True else "{}{}".format(stem, suffix))
+                    saved.append(save_name)
+                    writer = open_shard_writer(save_name, fields) if suffix == ".parquet" else None
+                    write_batch(batch, fields, save_name, header=True, writer=writer)
+                else:
+                    write_batch(batch, fields, save_name, header=False, writer=writer)
+                shard_rows += len(batch)
+                total += len(batch)
+                batch = []
+                if SHARD == True and shard_rows >= self.ROWS_PER_SHARD:
+                    if writer is not None:
+                        writer.close()
+                    yield save_name
+                    save_name = None
+                    writer = None
+                    shard_rows = 0
+
+        if len(batch) > 0 or len(saved) == 0:
+            if save_name is None:
+                save_name = self.csv_dir / ("{}_{}{}".format(stem, len(saved), suffix) if SHARD == True else "{}{}".format(stem, suffix))
+                saved.append(save_name)
+                writer = open_shard_writer(save_name, fields) if suffix == ".parquet" else None
+                write_batch(batch, fields, save_name, header=True, writer=writer)
+            else:
+                write_batch(batch, fields, save_name, header=False, writer=writer)
+            total += len(batch)
+        if writer is not None:
+            writer.close()
+        if save_name is not None:
+            yield save_name
+
+        logging.getLogger("messages").info("EXTRACT: {} row(s) written to {} file(s) ({})".format(total, len(saved), stem))
+
+    # shards of one input, passed on as they are completed; with a manifest they are held back until merged and recorded
+    def emit_shards(self, shards, file_saved):
+        for shard in shards:
+            if shard in file_saved:
+                continue
+            file_saved.append(shard)
+            if self.manifest is None:
+                yield shard
+
+    # keys as handed to the workers: None for the pool's own keywords, whose automata every worker already holds
+    def worker_keys(self, keys):
+        return None if keys is self.keywords else keys
+
+    # rows of a delimited input, read (only the needed columns) and filtered chunk by chunk
+    # note: appends "parent" to fields when file extraction needs it
+    def csv_rows(self, pool, f, fname, x, fields, to_change, keys, total_files):
+        usecols = list(self.filelist[x]["fields"])
+        if self.EXTRACT is None:
+            chunks = read_csv_chunks(f, self.filelist[x]["delim"], usecols, self.CHUNK_SIZE, self.CSV_ENGINE)
+            return (row for data in chunks for row in data.itertuples(index=False, name=None))
+
+        if self.FILE_EXTRACT == False:
+            chunks = read_csv_chunks(f, self.filelist[x]["delim"], usecols, self.CHUNK_SIZE, self.CSV_ENGINE)
+            records = (data.rename(columns={to_change:"text"})[fields].to_dict('records') for data in chunks)
+            return feed_chunks(pool, partial(filter_data, KEYS=self.worker_keys(keys), n=self.n, MODE=self.MODE, KEEP_NUM=self.KEEP_NUM), records)
+
+        sub_parent = None
+        if total_files > 1:
+            sub_parent = fname.stem
+            fields.append("parent")
+        elif len(self.settings[x]['files']) > 1 and "sample" in fname.as_posix():
+            fields.append("parent")
+            usecols.append("parent")
+        chunks = read_csv_chunks(f, self.filelist[x]["delim"], usecols, self.CHUNK_SIZE, self.CSV_ENGINE)
+        records = (file_records(data, to_change, sub_parent, fields) for data in chunks)
+        parent = self.settings[x]["file_extract_dir"]
+        return feed_chunks(pool, partial(filter_data, parent=parent, sub_parent=sub_parent, KEYS=self.worker_keys(keys), n=self.n, MODE=self.MODE, KEEP_NUM=self.KEEP_NUM), records)
+
+    # rows of all xml slices, in input order
+    def parse_xml(self, pool, tasks, fields, tags, keys):
+        parse = partial(parse_xml_slice, fields=fields, tags=tags, KEYS=self.worker_keys(keys), n=self.n, MODE=self.MODE, 
+                        KEEP_NUM=self.KEEP_NUM, FILTER=self.EXTRACT is not None)
+        if self.EXTRACT is not None:
+            func = partial(filter_data, KEYS=self.worker_keys(keys), n=self.n, MODE=self.MODE, KEEP_NUM=self.KEEP_NUM)
+        else:
+            func = entry_values
+        size = self.BATCH_SIZE if self.BATCH_SIZE is not None else 10000
+
+        # slices and inputs up to XML_SLICE_BYTES go to the workers whole; larger ones (files that cannot be split, big zip members)
+        # are parsed here and only filtered by the workers, batch by batch, so that no result list grows with the file
+        small = []
+        for task in tasks + [None]:
+            if task is not None and (task[2] is not None or task_bytes(task) <= self.XML_SLICE_BYTES):
+                small.append(task)
+                continue
+            done = 0 # entries of the slices so far
+            results = pool.imap(parse, small)
+            for res in results:
+                if res is None:
+                    # a slice did not parse: the rest of the file is parsed whole, here,
+                    # after the entries the slices before it already produced (the remaining slices are discarded)
+                    logging.getLogger("messages").info("EXTRACT: {} could not be sliced, parsing it whole".format(Path(small[0][0]).name))
+                    for _ in results:
+                        pass
+                    yield from feed_chunks(pool, func, xml_entry_batches(small[0], fields, tags, size, skip=done))
+                    break
+                done += res[0]
+                yield from res[1]
+            small = []
+            if task is not None:
+                yield from feed_chunks(pool, func, xml_entry_batches(task, fields, tags, size))
+
+    # worker: filter one _id range of a collection over a dedicated connection
+    def scan_range(self, task):
+        idx, (lower, upper), db, collection, mongo_fields, fields = task
+        client = self.mongo_client()
+        projection = {f:1 for f in mongo_fields}
+        if "_id" not in mongo_fields:
+            projection["_id"] = 0
+        cursor = client[db].get_collection(collection).find(range_query(lower, upper), projection)
+
+        filter_func = partial(filter_data, KEYS=None, n=self.n, MODE=self.MODE, KEEP_NUM=self.KEEP_NUM)
+        entries = ({f:doc.get(m, "") for f, m in zip(fields, mongo_fields)} for doc in cursor)
+        rows = (filter_func(e) for e in entries)
+
+        out_fields = [x for x in fields if x != "text"]+["text"]
+        saved = self.save_rows(rows, out_fields, "mongo_extract_{}".format(idx), SHARD=True)
+        client.close()
+        return saved
+
+    def extract(self):
+        return list(self.iter_extract())
+
+    # yields the shards of every input as soon as that input is done (for streaming consumers)
+    def iter_extract(self):
+        cache_stats = mp.Array('q', 2) # number cache hits, misses over all workers
+        with closing(mp.Pool(NUM_PROC, initializer=init_pool, initargs=(self.keywords, self.MODE, self.n, cache_stats))) as pool:
             for x in self.filelist.keys():
                 if "db" in self.settings[x] and self.filelist[x]['files'] is None:
                     fields = self.filelist[x]["fields"].copy()
@@ -315,35 +753,69 @@ class Extract:
                         else:
                             fields[change] = "text"
 
-                    mongo_fields = {f:1 for f in fields}
-                    client = get_mongo_client()
+                    # partitioned scan: every worker reads, filters and writes its own _id range
+                    client = self.mongo_client()
                     mongo_collection = client[self.settings[x]['db']].get_collection(self.settings[x]['collection'])
-                    mongo_gen = mongo_collection.find({}, mongo_fields)
-                    rows = pool.imap_unordered(partial(filter_data, KEYS=self.keys, n=self.n, MODE=self.MODE, KEEP_NUM=self.KEEP_NUM), mongo_gen, chunksize=10)
-                    rows = [row for row in rows]
-                    rows = list(filter(None, rows))
-
-                    fields = [x for x in fields if x != "text"]+["text"]
-                    to_df = split_and_dict(rows, fields)
-                    del rows
-                    for db_idx, temp in enumerate(np.array_split(to_df, math.ceil(len(to_df) / 1000000))):
-                        df = pd.DataFrame(temp, columns=fields)
-                        #del to_df
-                        df = df.replace("", np.nan)
-                        df = df.dropna()
-                        save_name = self.csv_dir / ("mongo_extract_{}.csv".format(db_idx))
-                        df.to_csv(save_name, index=False, quoting=0)
-                        saved.append(save_name)
-                        del df
+                    ranges = get_id_ranges(mongo_collection, self.PARTITIONS if self.PARTITIONS is not None else 4 * NUM_PROC)
+                    client.close()
+                    logging.getLogger("messages").info("EXTRACT: scanning {}/{} in {} partition(s)".format(self.settings[x]['db'], 
+                                                        self.settings[x]['collection'], len(ranges)))
+
+                    tasks = [(i, r, self.settings[x]['db'], self.settings[x]['collection'], self.filelist[x]["fields"], fields) for i, r in enumerate(ranges)]
+                    mongo_saved = []
+                    for shards in pool.imap_unordered(self.scan_range, tasks):
+                        mongo_saved.extend(shards)
+                    yield from sorted(mongo_saved)
 
                 else:
                     total_files = len(self.filelist[x]['files'])
                     for idx, fname in enumerate(self.filelist[x]["files"]):
                         logging.getLogger("messages").info("EXTRACT: processing file {}/{} for input {} - {}".format(idx+1, total_files, x, fname.stem))
+
+                        # incremental: skip unchanged files, only scan for newly added keywords
+                        keys = self.keywords
+                        file_saved = []
+                        if self.manifest is not None:
+                            status, entry, sig = self.check_manifest(fname, self.filelist[x]["fields"])
+                            if status == "unchanged":
+                                reused = self.reuse_shards(entry)
+                                self.update_manifest(fname, sig, reused)
+                                logging.getLogger("messages").info("EXTRACT: {} unchanged, reusing previous results".format(fname.stem))
+                                yield from reused
+                                continue
+                            elif status == "new_keys":
+                                keys = [k for k in self.keywords if k not in entry['keywords']]
+                                logging.getLogger("messages").info("EXTRACT: {} unchanged, scanning for {} new keyword(s)".format(fname.stem, len(keys)))
+
                         if "db" not in self.settings[x] and "zip" in self.filelist[x]["ext"].lower():
                             with zipfile.ZipFile(Path(fname).as_posix(),'r') as z:
-                                # go through all files in zip (should just be one)
-                                for subd in z.namelist():
+                                members = z.namelist()
+                            fields = self.filelist[x]["fields"].copy()
+                            to_change = None
+                            if self.EXTRACT is not None:
+                                change = None
+                                for i, find in enumerate(fields):
+                                    if find == self.EXTRACT:
+                                        change = i
+                                        break
+                                to_change = fields[change]
+                                fields[change] = "text"
+
+                            # xml members are parsed in parallel, one worker per member
+                            xml_members = [m for m in members if "xml" in os.path.splitext(m)[1]]
+                            if len(xml_members) > 0:
+                                if self.EXTRACT is not None:
+                                    tags = tuple(t for t in self.filelist[x]["fields"] if t != to_change) + (to_change,)
+                                else:
+                                    tags = tuple(t for t in self.filelist[x]["fields"])
+                                tasks = [(Path(fname).as_posix(), m, None, None, None) for m in xml_members]
+                                rows = self.parse_xml(pool, tasks, fields, tags, keys)
+                                yield from self.emit_shards(self.iter_save_rows(rows, [x for x in fields if x != "text"]+["text"], Path(fname).stem, SHARD=self.SHARD_FILES), file_saved)
+                                del rows
+
+                            with zipfile.ZipFile(Path(fname).as_posix(),'r') as z:
+                                # go through all other files in zip (should just be one)
+                                for subd in [m for m in members if m not in xml_members]:
                                     with z.open(subd) as f:
                                         fields = self.filelist[x]["fields"].copy()
                                         to_change = None
@@ -354,69 +826,21 @@ class Extract:
                                                     change = i
                                                     break
                                             to_change = fields[change]
-                                            fields[change] = "text"
-
-                                        if "xml" in os.path.splitext(subd)[1]:
-                                            if self.EXTRACT is not None:
-                                                tags = tuple(t for t in self.filelist[x]["fields"] if t != to_change) + (to_change,)
-                                                xml = etree.iterparse(f, events=('end',), tag=tags)
-                                                rows = list(pool.imap_unordered(partial(filter_data, KEYS=self.keys, KEEP_NUM=self.KEEP_NUM), generate_entries(xml, fields), chunksize=10)) # start filter job
-                                                rows = list(filter(None, rows)) # remove entries where nothing was found 
+                                            if self.FILE_EXTRACT == True:
+                                                fields[change] = "filename"
                                             else:
-                                                tags = tuple(t for t in self.filelist[x]["fields"])
-                                                xml = etree.iterparse(f, events=('end',), tag=tags)
-                                                rows = list(generate_entries(xml, fields))
-                                                rows = [":::".join(x) for x in rows] 
-                                                rows = list(filter(None, rows)) 
-                                            del xml
-                                        else:
-                                            data = pd.read_csv(f, dtype=str, delimiter=self.filelist[x]["delim"])[self.filelist[x]["fields"]]
-                                            if self.EXTRACT is not None:
-                                                if self.FILE_EXTRACT == False:
-                                                    data = data.rename(columns={to_change:"text"})
-                                                    data = data[fields]
-                                                    rows = data.to_dict('records')
-                                                    rows = pool.imap_unordered(partial(filter_data, KEYS=self.keys, KEEP_NUM=self.KEEP_NUM), rows, chunksize=10)
-                                                    rows = [row for row in rows]
-                                                    rows = list(filter(None, rows))
-                                                else:
-                                                    sub_parent = None
-                                                    if total_files > 1:
-                                                        data['parent'] = fname.stem
-                                                        sub_parent = fname.stem
-                                                        fields.append("parent")
-                                                    elif len(self.settings[x]['files']) > 1 and "sample" in fname.as_posix():
-                                                        fields.append("parent")
-                                                        data = pd.read_csv(fname, dtype=str, delimiter=self.settings[x]["delim"])[fields]
-
-                                                    data = data.rename(columns={to_change:"filename"})
-                                                    data['filename'] = data['filename'].fillna("")
-                                                    parent = self.settings[x]["file_extract_dir"]
-                                                    data = data[fields]
-                                                    rows = data.to_dict('records')
-                                                    rows = pool.imap_unordered(partial(filter_data, parent=parent, sub_parent=sub_parent, KEYS=self.keywords, n=self.n, MODE=self.MODE, KEEP_NUM=self.KEEP_NUM), rows, chunksize=10)
-                                                    rows = [row for row in rows]
-                                                    rows = list(filter(None, rows))
-                                            else:
-                                                rows = data.to_dict('records')
-                                                rows = [":::".join(x) for x in rows]
+                                                fields[change] = "text"
+
+                                        rows = self.csv_rows(pool, f, fname, x, fields, to_change, keys, total_files)
 
+                                        # export to csv, while the file is still open
                                         if self.FILE_EXTRACT == True:
                                             fields = [x for x in fields if x != "filename"]+["text"] 
                                         else: 
                                             fields = [x for x in fields if x != "text"]+["text"]
-                                        # export to dataframe and then to csv
                                         fields = [x for x in fields if x != "text"]+["text"]
-                                        to_df = split_and_dict(rows, fields)
+                                        yield from self.emit_shards(self.iter_save_rows(rows, fields, Path(fname).stem, SHARD=self.SHARD_FILES), file_saved)
                                         del rows
-                                        df = pd.DataFrame(to_df, columns=fields)
-                                        del to_df
-                                        df = df.replace("", np.nan)
-                                        df = df.dropna()
-                                        save_name = self.csv_dir / (Path(fname).stem+".csv")
-                                        df.to_csv(save_name, index=False, quoting=0)
-                                        saved.append(save_name)
-                                        del df
                         else:
                             fields = self.filelist[x]["fields"].copy()
                             to_change = None
@@ -433,67 +857,47 @@ class Extract:
                                     fields[change] = "text"
 
                             if "xml" in os.path.splitext(fname.name)[1]:
-                                with open(fname, 'rb') as f:
-                                    if self.EXTRACT is not None:
-                                        tags = tuple(t for t in self.filelist[x]["fields"] if t != to_change) + (to_change,)
-                                        xml = etree.iterparse(f, events=('end',), tag=tags)
-                                        rows = list(pool.imap_unordered(partial(filter_data, KEYS=self.keys, KEEP_NUM=self.KEEP_NUM), generate_entries(xml, fields), chunksize=10)) # start filter job
-                                        rows = list(filter(None, rows)) # remove entries where nothing was found 
-                                    else:
-                                        tags = tuple(t for t in self.filelist[x]["fields"])
-                                        xml = etree.iterparse(f, events=('end',), tag=tags)
-                                        rows = list(generate_entries(xml, fields))
-                                        rows = [":::".join(x) for x in rows] 
-                                        rows = list(filter(None, rows)) 
-                                del xml
-                            else:
-                                data = pd.read_csv(fname, dtype=str, delimiter=self.settings[x]["delim"])[self.filelist[x]["fields"]]
                                 if self.EXTRACT is not None:
-                                    if self.FILE_EXTRACT == False:
-                                        data = data.rename(columns={to_change:"text"})
-                                        data = data[fields]
-                                        rows = data.to_dict('records')
-                                        rows = pool.imap_unordered(partial(filter_data, KEYS=self.keywords, n=self.n, MODE=self.MODE, KEEP_NUM=self.KEEP_NUM), rows, chunksize=10)
-                                        rows = [row for row in rows]
-                                        rows = list(filter(None, rows))
-                                    else:
-                                        sub_parent = None
-                                        if total_files > 1:
-                                            data['parent'] = fname.stem
-                                            sub_parent = fname.stem
-                                            fields.append("parent")
-                                        elif len(self.settings[x]['files']) > 1 and "sample" in fname.as_posix():
-                                            fields.append("parent")
-                                            data = pd.read_csv(fname, dtype=str, delimiter=self.settings[x]["delim"])[fields]
-
-                                        data = data.rename(columns={to_change:"filename"})
-                                        data['filename'] = data['filename'].fillna("")
-                                        parent = self.settings[x]["file_extract_dir"]
-                                        data = data[fields]
-                                        rows = data.to_dict('records')
-                                        rows = pool.imap_unordered(partial(filter_data, parent=parent, sub_parent=sub_parent, KEYS=self.keywords, n=self.n, MODE=self.MODE, KEEP_NUM=self.KEEP_NUM), rows, chunksize=10)
-                                        rows = [row for row in rows]
-                                        rows = list(filter(None, rows))
+                                    tags = tuple(t for t in self.filelist[x]["fields"] if t != to_change) + (to_change,)
+                                else:
+                                    tags = tuple(t for t in self.filelist[x]["fields"])
+
+                                # byte ranges of whole records, each parsed and filtered by a worker
+                                slices = find_xml_slices(fname.as_posix(), tags, self.XML_SLICE_BYTES)
+                                if slices is None:
+                                    tasks = [(fname.as_posix(), None, None, None, None)]
                                 else:
-                                    rows = data.to_dict('records')
-                                    rows = [":::".join(x) for x in rows]
+                                    tasks = [(fname.as_posix(), None, start, end, header) for start, end, header in slices]
+                                logging.getLogger("messages").info("EXTRACT: parsing {} in {} slice(s)".format(fname.stem, len(tasks)))
+                                rows = self.parse_xml(pool, tasks, fields, tags, keys)
 
-                            # export to dataframe and then to csv
-                            if self.FILE_EXTRACT == True:
-                                fields = [x for x in fields if x != "filename"]+["text"] 
-                            else: 
                                 fields = [x for x in fields if x != "text"]+["text"]
-                            to_df = split_and_dict(rows, fields)
-                            del rows
-                            df = pd.DataFrame(to_df, columns=fields)
-                            del to_df
-                            df = df.replace("", np.nan)
-                            df = df.dropna()
-                            save_name = self.csv_dir / (Path(fname).stem+".csv")
-                            df.to_csv(save_name, index=False, quoting=0)
-                            saved.append(save_name)
-                            del df
+                                yield from self.emit_shards(self.iter_save_rows(rows, fields, Path(fname).stem, SHARD=self.SHARD_FILES), file_saved)
+                                del rows
+                            else:
+                                rows = self.csv_rows(pool, fname, fname, x, fields, to_change, keys, total_files)
+
+                                # export to csv
+                                if self.FILE_EXTRACT == True:
+                                    fields = [x for x in fields if x != "filename"]+["text"] 
+                                else: 
+                                    fields = [x for x in fields if x != "text"]+["text"]
+                                yield from self.emit_shards(self.iter_save_rows(rows, fields, Path(fname).stem, SHARD=self.SHARD_FILES), file_saved)
+                                del rows
+
+                        if self.manifest is not None:
+                            if status == "new_keys":
+                                for shard in file_saved:
+                                    old_shard = self.find_shard(entry, shard)
+                                    if old_shard is not None:
+                                        merge_shards(old_shard, shard)
+                            self.update_manifest(fname, sig, file_saved)
+                            yield from file_saved
                     
             pool.close()
             pool.join()
-        return saved
+
+        if self.KEEP_NUM == True:
+            lookups = cache_stats[0] + cache_stats[1]
+            logging.getLogger("messages").info("EXTRACT: number cache hit rate {:.1f}% ({} of {} lookups)".format(
+                100.0 * cache_stats[0] / lookups if lookups > 0 else 0.0, cache_stats[0], lookups))
@@ -10,12 +10,71 @@ import multiprocessing as mp
 import logging
 from contextlib import closing
 from pandarallel import pandarallel
+from Reader import read_shard, read_rule_table
+from Matcher import get_rule_set, get_matcher, unique_ints
+from EmbedCache import EmbeddingCache, unit_rows
+from VectorIndex import IVFIndex
 
 from sentence_transformers import SentenceTransformer
-from sentence_transformers.util import cos_sim
 
 pandarallel.initialize()
 
+NUM_PROC = int(0.75 * mp.cpu_count())
+
+# for worker access: the extrapolation (with its parsed rule tables), shipped once per worker
+def init_pool(e):
+    global global_extrapolate
+    global_extrapolate = e
+
+    # compile the rule automata once per worker
+    for rules, _, _ in e.rule_tables:
+        get_rule_set(rules)
+
+def extrapolate_file(task):
+    return global_extrapolate.extrapolate_file(*task)
+
+# vectorized get_matches over a whole shard: tags of the highest priority rule per row
+# chunks of all rows are matched in one pass, then the top rule per row is found by sorting (row, -prio, rule)
+def match_shard(texts, rule_set, tags, rule_tags):
+    splitted = [str(t).split('|') for t in texts]
+    lengths = np.fromiter((len(x) for x in splitted), dtype=np.int64, count=len(splitted))
+    row_of = np.repeat(np.arange(len(splitted)), lengths) # chunk -> row
+    chunks = [c for x in splitted for c in x]
+    del splitted
+
+    rules = rule_set.rules
+    pair_rules, pair_chunks = rule_set.hit_pairs(chunks)
+    keys = unique_ints(pair_rules * len(texts) + row_of[pair_chunks]) # (rule, row) pairs
+    pair_rules = keys // max(len(texts), 1)
+    pair_rows = keys % max(len(texts), 1)
+
+    values = np.zeros((len(texts), len(tags)), dtype=object)
+    values[:] = 0
+    if len(pair_rows) > 0:
+        # a regex rule only counts once some plain rule up to it has matched in the row
+        literal = np.array(["REGEX" not in r for r in rules])
+        first_literal = np.full(len(texts), len(rules))
+        is_literal = literal[pair_rules]
+        np.minimum.at(first_literal, pair_rows[is_literal], pair_rules[is_literal])
+        keep = pair_rules >= first_literal[pair_rows]
+        pair_rows = pair_rows[keep]
+        pair_rules = pair_rules[keep]
+
+        prio = np.array([int(rule_tags[r]['prio']) for r in rules])
+        order = np.lexsort((pair_rules, -prio[pair_rules], pair_rows))
+        sorted_rows = pair_rows[order]
+        first = np.ones(len(sorted_rows), dtype=bool) # first pair of each row (none left if only regex rules hit)
+        first[1:] = sorted_rows[1:] != sorted_rows[:-1]
+        top_rows = sorted_rows[first]
+        top_rules = pair_rules[order][first]
+
+        encoding = np.empty((len(rules), len(tags)), dtype=object)
+        for k, r in enumerate(rules):
+            encoding[k] = [rule_tags[r]['encoding'][t] for t in tags]
+        values[top_rows] = encoding[top_rules]
+
+    return pd.DataFrame(values, columns=tags).infer_objects()
+
 class Extrapolate:
     pid = None
     project = None
@@ -25,10 +84,21 @@ class Extrapolate:
     id = None
     THRESHOLD = None
     model = None
+    MODEL_NAME = 'sentence-transformers/all-MiniLM-L6-v2'
+    cache = None # embeddings on disk, shared by all classes and runs
+    EMBED_QUEUE = 100000 # distinct chunks collected (over rows and files) before they are encoded
+    EMBED_MODE = "centroid" # "centroid": similarity to the mean rule vector per class, "rule": to every rule vector (ANN index)
+    EMBED_TOP_K = None # "rule" mode: only the k most similar rules count (None: all rules above THRESHOLD)
+    rule_index = None
+    rule_classes = None # rule x class membership, rows as in rule_index
     EMBED = False
     KEYWORDS = None
+    VECTORIZED = True # match whole shards at once (False: row by row with get_matches)
+    rule_tables = None
+    PARALLEL = True # one input file per worker process
 
-    def __init__(self, pid, basename, files, rfs, project, id, THRESHOLD=None, EMBED=False, KEYWORDS=None):
+    def __init__(self, pid, basename, files, rfs, project, id, THRESHOLD=None, EMBED=False, KEYWORDS=None, PARALLEL=True, EMBED_DTYPE="float32", EMBED_BATCH_SIZE=256, EMBED_THREADS=1,
+                 EMBED_MODE="centroid", EMBED_TOP_K=None, ANN_NLIST=None, ANN_NPROBE=8):
         self.pid = pid
         self.project = project
         self.basename = basename
@@ -37,60 +107,45 @@ class Extrapolate:
         self.id = id
         self.THRESHOLD = THRESHOLD
         self.EMBED = EMBED
+        self.PARALLEL = PARALLEL
         if self.EMBED == True:
             self.KEYWORDS = KEYWORDS
-            self.model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2', device="cpu")
+            self.model = SentenceTransformer(self.MODEL_NAME, device="cpu")
+            self.cache = EmbeddingCache(Path(self.project) / "embeddings", self.model, self.MODEL_NAME, DTYPE=EMBED_DTYPE,
+                                        BATCH_SIZE=EMBED_BATCH_SIZE, THREADS=EMBED_THREADS)
             self.class_vectors = self.create_class_vectors(self.rule_files)
+            self.EMBED_MODE = EMBED_MODE
+            self.EMBED_TOP_K = EMBED_TOP_K
+            if self.EMBED_MODE == "rule":
+                self.rule_index = self.create_rule_index(self.rule_files, NLIST=ANN_NLIST, NPROBE=ANN_NPROBE)
             logging.getLogger("messages").info("EXTRAPOLATE (EMBED): init complete")
         else:
+            self.rule_tables = [read_rule_table(r) for r in self.rule_files]
             logging.getLogger("messages").info("EXTRAPOLATE: init complete")
 
-    def get_matches(self, row, rules, tags, rule_tags):
+    # tags of the highest priority rule hitting the text
+    # (a regex rule only counts once some plain rule up to it has matched)
+    def get_matches(self, row, rule_set, tags, rule_tags):
         import pandas as pd
-        import re
-        import random
         from collections import OrderedDict
 
         text = row['text']
 
-        temp = []
         splitted = text.split('|')
-        matched_indices = []
-        matched_ones = []
-        for r in rules:
-            match = []
-            for idx, x in enumerate(splitted):
-                found_match = False
-                if "REGEX" in r:
-                    regex = re.compile(r.split(':::')[1])
-                    if re.search(regex, x):
-                        match.append((x,1))
-                elif r in x:
-                    match.append((x,1))
-                    found_match = True
-
-                if found_match == True:
-                    matched_indices.append(idx)
-            random.shuffle(match)
-            for m, z in zip(match, matched_indices):
-                if m[1] == 1:
-                    if any(rule_tags[r]['encoding'][code] == 1 for code in rule_tags[r]['encoding']):
-                        matched_ones.append(z)
-                    temp.append({**{"chunk":m[0], "rule": r, "match":int(rule_tags[r]['prio'])},**rule_tags[r]['encoding']})
-                else:
-                    temp.append({**{"chunk":m[0], "rule": r, "match":int(rule_tags[r]['prio'])},**{k:0 for k in rule_tags[r]['encoding'].keys()}})
-        
-        matched_ones = sorted(list(set(matched_ones)))
+        hits, _ = rule_set.match(splitted) # one pass over all rules
+        top = None
+        literal_hits = 0
+        for r in rule_set.rules:
+            if "REGEX" not in r:
+                literal_hits += len(hits[r])
+            if len(hits[r]) > 0 and literal_hits > 0:
+                if top is None or int(rule_tags[r]['prio']) > int(rule_tags[top]['prio']):
+                    top = r
 
         ret_dict = OrderedDict()
-        if len(temp) > 0:
-            top = max(temp, key=lambda x: x['match'])
-            #return pd.Series({k:top[k] for k in tags})
+        if top is not None:
             for k in tags:
-                #ret_dict['chunk'] = top['chunk']
-                #ret_dict['rule'] = top['rule']
-                #ret_dict['indices'] = ';'.join([str(x) for x in matched_ones])
-                ret_dict[k] = top[k]
+                ret_dict[k] = rule_tags[top]['encoding'][k]
             if len(ret_dict.keys()) > 0:
                 return pd.Series(ret_dict)
             else:
@@ -105,36 +160,106 @@ class Extrapolate:
             tags = df.columns[2:].to_list()
             for t in tags:
                 rules = df[df[t] == 1]["rule"].to_list()
-                embeddings = self.model.encode(rules)
+                embeddings = self.cache.encode(rules)
                 avg = np.mean(embeddings, axis=0)
                 class_vectors[t] = avg
                 
         return class_vectors
-    
-    def embed_sim(self, class_vector, class_keywords, THRESHOLD, text):    
-        text = [x for x in text.split('|') if any(y in x for y in class_keywords)]
-        if len(text) == 0:
-            return ""
-        
-        text_encode = self.model.encode(text)
-        sim_scores = cos_sim(class_vector, text_encode)[0]
-        if any(x > THRESHOLD for x in sim_scores):
-            evidence = [text[i] for i, x in enumerate(sim_scores) if x > THRESHOLD]
-            return "|".join(evidence)
+
+    # index over every rule vector, plus which classes each rule belongs to (rules as in create_class_vectors)
+    def create_rule_index(self, rule_files, NLIST=None, NPROBE=8):
+        class_rules = {}
+        for r in rule_files:
+            df = pd.read_csv(r)
+            for t in df.columns[2:].to_list():
+                class_rules[t] = df[df[t] == 1]["rule"].to_list()
+
+        classes = list(self.class_vectors.keys())
+        rules = list(dict.fromkeys(x for c in classes for x in class_rules[c]))
+        position = {x:i for i, x in enumerate(rules)}
+        self.rule_classes = np.zeros((len(rules), len(classes)), dtype=bool)
+        for j, c in enumerate(classes):
+            self.rule_classes[[position[x] for x in class_rules[c]], j] = True
+        return IVFIndex(self.cache.encode(rules), NLIST=NLIST, NPROBE=NPROBE)
+
+    # per chunk and class, the highest similarity to a rule of the class among the neighbours found (-inf: none)
+    def rule_sims(self, encoded):
+        sims = np.full((len(encoded), self.rule_classes.shape[1]), -np.inf, dtype=np.float32)
+        if self.EMBED_TOP_K is not None:
+            ids, best = self.rule_index.search(encoded, self.EMBED_TOP_K)
+            q = np.repeat(np.arange(len(encoded)), ids.shape[1])
+            found = ids.ravel() >= 0
+            q, r, s = q[found], ids.ravel()[found], best.ravel()[found]
         else:
-            return ""
+            q, r, s = self.rule_index.range_search(encoded, self.THRESHOLD)
+        for j in range(sims.shape[1]):
+            member = self.rule_classes[r, j]
+            np.maximum.at(sims[:, j], q[member], s[member])
+        return sims
+    
+    # split rows into chunks: (chunks per row, distinct chunk -> position, distinct chunk x class keyword hits)
+    def embed_candidates(self, texts, classes):
+        matchers = [get_matcher(self.KEYWORDS[c]) for c in classes]
+        splitted = [str(t).split('|') for t in texts]
+
+        chunks = {}
+        for x in splitted:
+            for s in x:
+                if s not in chunks:
+                    chunks[s] = len(chunks)
+        keyword_hits = np.array([[m.search(s) for m in matchers] for s in chunks], dtype=bool).reshape(len(chunks), len(classes))
+        return splitted, chunks, keyword_hits
+
+    # per class, the evidence of every row: its keyword-filtered chunks with a similarity above THRESHOLD
+    # (to the class vector, or in "rule" mode to any rule of the class)
+    # each distinct chunk is encoded at most once for all classes
+    def embed_evidence(self, texts):
+        classes = list(self.class_vectors.keys())
+        splitted, chunks, keyword_hits = self.embed_candidates(texts, classes)
+        candidates = np.flatnonzero(keyword_hits.any(axis=1))
+
+        sims = np.zeros((len(chunks), len(classes)), dtype=np.float32)
+        if len(candidates) > 0:
+            chunk_list = list(chunks)
+            encoded = self.cache.encode([chunk_list[i] for i in candidates])
+            if self.EMBED_MODE == "rule":
+                sims[candidates] = self.rule_sims(encoded)
+            else:
+                sims[candidates] = unit_rows(encoded) @ unit_rows(np.array([self.class_vectors[c] for c in classes])).T
+        evidence_mask = keyword_hits & (sims > self.THRESHOLD)
+
+        evidence = {}
+        for j, c in enumerate(classes):
+            evidence[c] = ["|".join(s for s in x if evidence_mask[chunks[s], j]) for x in splitted]
+        return evidence
+
+    # encode the candidate chunks of all files ahead of time, in large batches spanning rows and files
+    def embed_prefetch(self, files):
+        classes = list(self.class_vectors.keys())
+        queue = {}
+        for f in files:
+            texts = read_shard(f, columns=["text"])["text"].to_list()
+            _, chunks, keyword_hits = self.embed_candidates(texts, classes)
+            for s, hit in zip(chunks, keyword_hits.any(axis=1)):
+                if hit:
+                    queue[s] = None
+            if len(queue) >= self.EMBED_QUEUE:
+                self.cache.fill(list(queue))
+                queue = {}
+        self.cache.fill(list(queue))
+
+        logging.getLogger("messages").info("EXTRAPOLATE (EMBED): {} chunks encoded in {:.1f}s ({:.1f} chunks/sec, batch size {}, {} thread(s)), {} from cache".format(
+            self.cache.misses, self.cache.encode_time, self.cache.throughput(), self.cache.BATCH_SIZE, self.cache.THREADS, self.cache.hits))
 
     def __extra_helper_embed__(self, fname): 
-        sub_df = pd.read_csv(fname).set_index(self.id)
+        sub_df = read_shard(fname).set_index(self.id)
 
         if len(sub_df.index) == 0:
             return None
 
+        all_evidence = self.embed_evidence(sub_df["text"].to_list())
         for c in self.class_vectors: 
-            class_vector = self.class_vectors[c]
-            class_keywords = self.KEYWORDS[c]
-            
-            evidence = sub_df["text"].apply(lambda x: self.embed_sim(class_vector, class_keywords, self.THRESHOLD, x))
+            evidence = all_evidence[c]
             mask = [True if x != "" else False for x in evidence]
             evidence = [x for x in evidence if x != ""]
             temp = sub_df[mask].copy()
@@ -147,29 +272,24 @@ class Extrapolate:
             sub_df = sub_df.join(data, how="left").fillna(0)
             sub_df[c] = sub_df[c].astype(int)
             del data
-            
         sub_df = sub_df.reset_index()
         return sub_df
 
     def __extra_helper__(self, fname):
         #print("Processing {}...".format(fname.stem), flush=True)
-        sub_df = pd.read_csv(fname).set_index(self.id)
+        sub_df = read_shard(fname).set_index(self.id)
 
         if len(sub_df.index) == 0:
             return None
 
-        for r in self.rule_files:
-            rule_data = pd.read_csv(r)
-            rules = rule_data['rule'].to_list()
-            tags = rule_data.columns[2:].to_list()
-            rule_tags = {}
-            for _, row in rule_data.iterrows():
-                rule_tags[row['rule']] = {}
-                rule_tags[row['rule']]['encoding'] = row[2:].to_dict()
-                rule_tags[row['rule']]['prio'] = row['prio']
-
-            data = sub_df.swifter.progress_bar(False).apply(lambda x: self.get_matches(x, rules, tags, rule_tags), axis=1)
-            #data = sub_df.parallel_apply(lambda x: self.get_matches(x, rules, tags, rule_tags), axis=1)
+        for rules, tags, rule_tags in self.rule_tables:
+            rule_set = get_rule_set(rules)
+
+            if self.VECTORIZED == True:
+                data = match_shard(sub_df["text"].to_list(), rule_set, tags, rule_tags).set_index(sub_df.index)
+            else:
+                data = sub_df.swifter.progress_bar(False).apply(lambda x: self.get_matches(x, rule_set, tags, rule_tags), axis=1)
+            #data = sub_df.parallel_apply(lambda x: self.get_matches(x, rule_set, tags, rule_tags), axis=1)
             if data is None or len(data.index) == 0:
                 continue
             elif data.index.name != self.id:
@@ -179,8 +299,7 @@ class Extrapolate:
                 to_add = [x for x in tags if x in sub_df.columns[2:]]
                 sub_df = sub_df.join(data, how="left", lsuffix='_left', rsuffix='_right').fillna(0)
                 for a in to_add:
-                    sub_df[a] = sub_df.apply(lambda x: 1 if (x[a+'_left'] + x[a+'_right']) > 0 else 0, axis=1)
-                    sub_df[a] = sub_df[a].astype(int)
+                    sub_df[a] = ((sub_df[a+'_left'] + sub_df[a+'_right']).to_numpy() > 0).astype(int)
                     sub_df = sub_df.drop(columns=[a+'_left', a+'_right'])
             else:
                 new_cols = [x for x in data.columns if x not in sub_df.columns]
@@ -194,23 +313,36 @@ class Extrapolate:
         sub_df = sub_df.reset_index()
         return sub_df
 
+    # extrapolate one input file into its own output shard (None if there was nothing to write)
+    def extrapolate_file(self, fname, name):
+        if self.EMBED == True:
+            sub_df = self.__extra_helper_embed__(fname)
+        else:
+            sub_df = self.__extra_helper__(fname)
+        if sub_df is None:
+            return None
+
+        sub_df = sub_df.sample(frac=1, random_state=42)
+        sub_df.to_csv(name.as_posix(), index=False)
+        return name
+
+    # writes one {basename}_full_<shard>.csv per input file, returns their paths
     def extrapolate(self):
         logging.getLogger("messages").info("EXTRAPOLATE: extrapolation begun")
 
-        all_data = []
-        #with closing(mp.Pool(mp.cpu_count())) as pool:
-        #    all_data = list(pool.map(self.__extra_helper__, self.files))
-        for f in self.files:
-            if self.EMBED == True:
-                all_data.append(self.__extra_helper_embed__(f))
-            else:
-                all_data.append(self.__extra_helper__(f))
+        save_dir = Path(self.project) / "csv" / str(self.pid)
+        tasks = [(Path(f), save_dir / "{}_full_{}.csv".format(self.basename, Path(f).stem)) for f in self.files]
+
+        if self.EMBED == True:
+            self.embed_prefetch([f for f, _ in tasks])
 
-        logging.getLogger("messages").info("EXTRAPOLATE: merging results")
-        merged = pd.concat(all_data, ignore_index=True)
-        del all_data
-        merged = merged.sample(frac=1, random_state=42)
+        # the embedding model stays in this process, and row by row matching uses swifter's own workers
+        if self.PARALLEL == True and self.EMBED == False and self.VECTORIZED == True and NUM_PROC > 1 and len(tasks) > 1:
+            with closing(mp.Pool(min(NUM_PROC, len(tasks)), initializer=init_pool, initargs=(self,))) as pool:
+                saved = list(pool.imap_unordered(extrapolate_file, tasks))
+        else:
+            saved = [self.extrapolate_file(f, name) for f, name in tasks]
 
-        name = Path(self.project) / "csv" / str(self.pid) / "{}_full.csv".format(self.basename)
-        merged.to_csv(name.as_posix(), index=False)
-        return name
\ No newline at end of file
+        saved = sorted(s for s in saved if s is not None)
+        logging.getLogger("messages").info("EXTRAPOLATE: {} shard(s) written".format(len(saved)))
+        return saved
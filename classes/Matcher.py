@@ -0,0 +1,266 @@
+# Author: Stephen Meisenbacher
+# Matcher.py
+# Aho-Corasick automaton for matching many keywords in one pass
+
+import re
+import numpy as np
+from bisect import bisect_right
+from collections import deque
+
+# regex parser, for the literals a pattern requires
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+# C implementation, used when installed (pip install pyahocorasick)
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+SEP = '\x00' # unit separator, never part of a keyword
+
+class KeywordMatcher:
+    keywords = None
+    EMPTY = False # '' is contained in every string
+
+    def __init__(self, keywords):
+        self.EMPTY = "" in keywords
+        self.keywords = list(dict.fromkeys(k for k in keywords if k != ""))
+
+        if ahocorasick is not None:
+            self.automaton = ahocorasick.Automaton()
+            for k in self.keywords:
+                self.automaton.add_word(k, k)
+            if len(self.keywords) > 0:
+                self.automaton.make_automaton()
+        else:
+            self.automaton = None
+            self.build()
+            # existence checks only need a single hit, so leave those to the regex engine
+            pattern = "|".join(re.escape(k) for k in sorted(self.keywords, key=len, reverse=True))
+            self.regex = re.compile(pattern) if len(self.keywords) > 0 else None
+
+    # pure python goto / fail / output tables
+    def build(self):
+        self.goto = [{}]
+        self.out = [()]
+        for k in self.keywords:
+            s = 0
+            for c in k:
+                if c not in self.goto[s]:
+                    self.goto.append({})
+                    self.out.append(())
+                    self.goto[s][c] = len(self.goto) - 1
+                s = self.goto[s][c]
+            self.out[s] = (k,)
+
+        self.fail = [0] * len(self.goto)
+        queue = deque(self.goto[0].values())
+        while queue:
+            s = queue.popleft()
+            for c, t in self.goto[s].items():
+                f = self.fail[s]
+                while f and c not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[t] = self.goto[f].get(c, 0)
+                self.out[t] = self.out[t] + self.out[self.fail[t]]
+                queue.append(t)
+
+    # yields (end index, keyword) for every (possibly overlapping) occurrence
+    def iter(self, text):
+        if len(self.keywords) == 0:
+            return
+        if self.automaton is not None:
+            yield from self.automaton.iter(text)
+            return
+
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        s = 0
+        for i, c in enumerate(text):
+            while s and c not in goto[s]:
+                s = fail[s]
+            s = goto[s].get(c, 0)
+            if out[s]:
+                for k in out[s]:
+                    yield i, k
+
+    # equivalent to any(k in text for k in keywords)
+    def search(self, text):
+        if self.EMPTY:
+            return True
+        if len(self.keywords) == 0:
+            return False
+        if self.automaton is not None:
+            return next(self.automaton.iter(text), None) is not None
+        return self.regex.search(text) is not None
+
+    # set of all keywords contained in text
+    def matches(self, text):
+        found = set(k for _, k in self.iter(text))
+        if self.EMPTY:
+            found.add("")
+        return found
+
+    # indices of all units (words, sentences, chunks) containing a keyword, in one pass
+    def find_units(self, units):
+        if self.EMPTY:
+            return list(range(len(units)))
+
+        ends = []
+        pos = 0
+        for u in units:
+            pos += len(u)
+            ends.append(pos)
+            pos += 1
+
+        found = []
+        for end, _ in self.iter(SEP.join(units)):
+            idx = bisect_right(ends, end)
+            if len(found) == 0 or found[-1] != idx:
+                found.append(idx)
+        return found
+
+    # (unit index, keyword) for every occurrence, in order of the units
+    def iter_units(self, units):
+        ends = []
+        pos = 0
+        for u in units:
+            pos += len(u)
+            ends.append(pos)
+            pos += 1
+
+        for end, k in self.iter(SEP.join(units)):
+            yield bisect_right(ends, end), k
+
+    # per-unit sets of contained keywords, in one pass
+    def unit_matches(self, units):
+        found = [set() for _ in units]
+        for idx, k in self.iter_units(units):
+            found[idx].add(k)
+        if self.EMPTY:
+            for f in found:
+                f.add("")
+        return found
+
+# compiled automata, built once per (worker) process
+_matchers = {}
+
+def get_matcher(keywords):
+    key = tuple(keywords)
+    if key not in _matchers:
+        _matchers[key] = KeywordMatcher(keywords)
+    return _matchers[key]
+
+# sorted unique values of an integer array (sorting is much faster than np.unique's hashing here)
+def unique_ints(a):
+    a = np.sort(a)
+    return a[np.concatenate(([True], a[1:] != a[:-1]))] if len(a) > 0 else a
+
+# a literal every match of the regex contains (the longest run of plain characters at the top level), or None
+def required_literal(regex):
+    if regex.flags & re.IGNORECASE:
+        return None
+    try:
+        parsed = sre_parse.parse(regex.pattern, regex.flags)
+    except Exception:
+        return None
+
+    best = ""
+    run = []
+    for op, arg in parsed:
+        if op == sre_parse.LITERAL:
+            run.append(chr(arg))
+        else:
+            best = max(best, "".join(run), key=len)
+            run = []
+    best = max(best, "".join(run), key=len)
+    return best if best != "" and SEP not in best else None
+
+# compiled rule file: literal rules go through one automaton, "REGEX:::<pattern>" rules are compiled once
+class RuleSet:
+    rules = None
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self.regex = {r:re.compile(r.split(':::')[1]) for r in self.rules if "REGEX" in r}
+        self.literal = set(r for r in self.rules if r not in self.regex)
+        self.matcher = KeywordMatcher(self.rules) # every rule string, also for "contains any rule"
+        # regex prefilter: only chunks containing the required literal are searched
+        self.required = {r:required_literal(regex) for r, regex in self.regex.items()}
+        self.required_matcher = KeywordMatcher([l for l in self.required.values() if l is not None])
+
+    # one pass over the chunks: rule -> indices of the chunks it hits,
+    # plus for every chunk whether any rule string occurs in it
+    def match(self, chunks):
+        hits = {r:[] for r in self.rules}
+        contains = [self.matcher.EMPTY] * len(chunks)
+        for idx, r in self.matcher.iter_units(chunks):
+            contains[idx] = True
+            if r in self.literal:
+                h = hits[r]
+                if len(h) == 0 or h[-1] != idx:
+                    h.append(idx)
+        if "" in self.literal:
+            hits[""] = list(range(len(chunks)))
+        for r, regex in self.regex.items():
+            hits[r] = [idx for idx, x in enumerate(chunks) if regex.search(x) is not None]
+        return hits, contains
+
+    # sparse hit matrix for many chunks at once: (rule position, chunk index) pairs, without duplicates
+    def hit_pairs(self, chunks):
+        ends = np.cumsum(np.fromiter((len(c) + 1 for c in chunks), dtype=np.int64, count=len(chunks))) - 1
+        literal = [r for r in dict.fromkeys(self.rules) if r in self.literal and r != ""]
+        ids = {r:i for i, r in enumerate(literal)}
+        joined = SEP.join(chunks)
+
+        # chunks that can match each prefiltered regex
+        candidates = {}
+        for end, l in self.required_matcher.iter(joined):
+            candidates.setdefault(l, []).append(end)
+        candidates = {l:unique_ints(np.searchsorted(ends, np.array(e, dtype=np.int64), side="right")) for l, e in candidates.items()}
+
+        found = [(end, ids[k]) for end, k in self.matcher.iter(joined) if k in ids]
+        pair_rules = []
+        pair_chunks = []
+        if len(found) > 0:
+            found_ends = np.fromiter((e for e, _ in found), dtype=np.int64, count=len(found))
+            found_ids = np.fromiter((i for _, i in found), dtype=np.int64, count=len(found))
+            keys = unique_ints(found_ids * len(chunks) + np.searchsorted(ends, found_ends, side="right"))
+            lit_ids = keys // len(chunks)
+            lit_chunks = keys % len(chunks)
+            for k, r in enumerate(self.rules):
+                if r in ids:
+                    idx = lit_chunks[np.searchsorted(lit_ids, ids[r]):np.searchsorted(lit_ids, ids[r], side="right")] # keys are sorted
+                    pair_rules.append(np.full(len(idx), k))
+                    pair_chunks.append(idx)
+
+        for k, r in enumerate(self.rules):
+            if r == "":
+                idx = np.arange(len(chunks))
+            elif r in self.regex:
+                regex = self.regex[r]
+                if self.required[r] is not None:
+                    idx = np.array([i for i in candidates.get(self.required[r], []) if regex.search(chunks[i]) is not None], dtype=np.int64)
+                else:
+                    idx = np.array([i for i, x in enumerate(chunks) if regex.search(x) is not None], dtype=np.int64)
+            else:
+                continue
+            pair_rules.append(np.full(len(idx), k))
+            pair_chunks.append(idx)
+
+        if len(pair_rules) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(pair_rules).astype(np.int64), np.concatenate(pair_chunks).astype(np.int64)
+
+# compiled rule sets, built once per rule file (and process)
+_rule_sets = {}
+
+def get_rule_set(rules):
+    key = tuple(rules)
+    if key not in _rule_sets:
+        _rule_sets[key] = RuleSet(rules)
+    return _rule_sets[key]
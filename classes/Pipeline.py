@@ -12,11 +12,15 @@ import swifter
 from pathlib import Path
 from datetime import datetime
 import sqlite3
+import time
 from Extract import Extract
+from DBWriter import DBWriter
+from Reader import read_csv_chunks, read_shard, CHUNK_SIZE
+from Matcher import get_matcher
 import multiprocessing as mp
-from multiprocessing.pool import ThreadPool
 from contextlib import closing
 from functools import partial
+from collections import deque
 import json
 import logging
 
@@ -27,6 +31,7 @@ stop = stopwords.words("english")
 N = 13
 center = int(N / 2)
 NUM_PROC = int(0.75 * mp.cpu_count())
+CLASS_BATCH = 100000 # chunks per predict call
 ##############################
 
 def key_index(text, keywords):
@@ -96,10 +101,120 @@ def classify(keys, CLASSIFIER, text):
         total += sum(pred)
     return 1 if total > 0 else 0
 
+# classify for a whole shard: the keyword-matching chunks of all rows are predicted together, in a few large calls
+# (each distinct chunk once), then every row gets 1 if any of its chunks is positive (scatter-max)
+def classify_batch(keys, CLASSIFIER, texts, BATCH_SIZE=CLASS_BATCH):
+    matcher = get_matcher(keys)
+    chunks = {} # distinct chunk -> position
+    chunk_ids = []
+    row_ids = []
+    for i, text in enumerate(texts):
+        if not isinstance(text, str):
+            continue # empty text
+        for chunk in text.split('|'):
+            if matcher.search(chunk):
+                row_ids.append(i)
+                chunk_ids.append(chunks.setdefault(chunk, len(chunks)))
+
+    return scatter_predict(CLASSIFIER, chunks, chunk_ids, row_ids, len(texts), BATCH_SIZE)
+
+# predict the distinct chunks in batches; row_ids[i] gets 1 if its chunk chunk_ids[i] is positive
+def scatter_predict(CLASSIFIER, chunks, chunk_ids, row_ids, n_rows, BATCH_SIZE=CLASS_BATCH):
+    labels = np.zeros(n_rows, dtype=np.int64)
+    if len(chunks) > 0:
+        to_pred = list(chunks)
+        pred = np.concatenate([np.asarray(CLASSIFIER['clf'].predict(to_pred[b:b+BATCH_SIZE])).ravel() for b in range(0, len(to_pred), BATCH_SIZE)])
+        np.maximum.at(labels, np.array(row_ids), (pred[np.array(chunk_ids)] > 0).astype(np.int64))
+    return labels
+
+# classify a shard for all tags at once: the distinct chunks are scanned in one pass, by one automaton over the
+# keywords of all tags, and routed to each tag with a keyword in them; then a batched predict per tag
+# tag_keys: tag -> keywords, classifiers: tag -> classifier; returns tag -> labels
+def classify_tags(tag_keys, classifiers, texts, BATCH_SIZE=CLASS_BATCH):
+    owners = {} # keyword -> tags
+    for t, keys in tag_keys.items():
+        for k in keys:
+            owners.setdefault(k, set()).add(t)
+    matcher = get_matcher(sorted(owners))
+
+    units = {} # distinct chunk -> position
+    chunk_of = [] # per chunk occurrence: distinct chunk, row
+    row_of = []
+    for i, text in enumerate(texts):
+        if not isinstance(text, str):
+            continue # empty text
+        for chunk in text.split('|'):
+            row_of.append(i)
+            chunk_of.append(units.setdefault(chunk, len(units)))
+    units = list(units)
+    chunk_of = np.array(chunk_of, dtype=np.int64)
+    row_of = np.array(row_of, dtype=np.int64)
+
+    hits = {t:set() for t in tag_keys} # distinct chunks routed to each tag
+    for idx, k in matcher.iter_units(units):
+        for t in owners[k]:
+            hits[t].add(idx)
+    for t in owners.get("", []): # '' is contained in every chunk
+        hits[t] = range(len(units))
+
+    labels = {}
+    for t in tag_keys:
+        routed = np.sort(np.fromiter(hits[t], dtype=np.int64, count=len(hits[t])))
+        pos = np.full(len(units), -1, dtype=np.int64) # distinct chunk -> position among the routed ones
+        pos[routed] = np.arange(len(routed))
+        mask = pos[chunk_of] >= 0
+        labels[t] = scatter_predict(classifiers[t], [units[j] for j in routed], pos[chunk_of[mask]], row_of[mask], len(texts), BATCH_SIZE)
+    return labels
+
+# pandas to_sql insert method: rows whose primary key is already stored are skipped by sqlite
+def insert_or_ignore(table, conn, keys, data_iter):
+    columns = ", ".join('"{}"'.format(k) for k in keys)
+    values = ", ".join("?" for _ in keys)
+    conn.executemany('INSERT OR IGNORE INTO "{}" ({}) VALUES ({})'.format(table.name, columns, values), data_iter)
+
 def init_pool(classifier):
     global CLASSIFIER
     CLASSIFIER = classifier
 
+# extract shard(s) as one frame, indexed by id, text column named "text"
+def read_extract(csv, extract):
+    data = []
+    cols = [x if x != extract['text'] else "text" for x in extract['fields']]
+    for c in csv:
+        temp_df = read_shard(c, columns=cols)
+        data.append(temp_df)
+    if extract['id'] is not None:
+        df = pd.concat(data, axis=0, ignore_index=True)
+        df = df.rename(columns={extract['id']:'id'}).set_index('id')
+    return df
+
+# for classifier worker access: classifiers, keywords and settings to classify a shard, shipped once per worker
+def init_class_pool(job):
+    global CLASS_JOB
+    CLASS_JOB = job
+
+# classifier stage: an extract shard in, its rows with a 0/1 column per tag out
+def classify_shard(fname):
+    job = CLASS_JOB
+    csv = read_extract([fname], job['extract'])
+    if job['multi_tag'] == True:
+        labels = classify_tags(job['keywords'], job['classifiers'], csv['text'].tolist())
+        for t in job['tags']:
+            csv[t] = labels[t]
+    else:
+        for t in job['tags']:
+            csv[t] = classify_batch(job['keywords'][t], job['classifiers'][t], csv['text'].tolist())
+    if job['keep_text'] == False:
+        csv = csv.drop(columns=['text', 'trimmed'], errors='ignore')
+    if job['main'] is not None:
+        csv = join_main(job['main'], csv, job['convert_t'])
+    return csv
+
+# the main rows of the ids in a classified shard, with the shard's columns (of a repeated id: its first row)
+def join_main(main, csv, convert_t):
+    csv = csv[~csv.index.duplicated(keep='first')]
+    return main[main.index.isin(csv.index)].join(csv, how="left").fillna(0).astype(convert_t)
+
 def _proc_helper_(keys, qual, keep, texts):
     global NUM_PROC
 
@@ -111,16 +226,7 @@ def _proc_helper_(keys, qual, keep, texts):
     return res
 
 def _class_helper_(classifier, keys, texts):
-    global NUM_PROC
-    #global CLASSIFIER
-
-    class_func = partial(classify, keys, classifier) 
-    #with closing(mp.Pool(NUM_PROC, init_pool(classifier['clf']))) as pool:
-    with closing(ThreadPool(NUM_PROC)) as pool:
-        res = pool.map(class_func, texts)
-        pool.close()
-        pool.join()
-    return res
+    return classify_batch(keys, classifier, list(texts))
     
 def _merge_helper_(id, con):
     cursor = con.cursor()
@@ -153,7 +259,11 @@ class Pipeline:
     db_table = None
     con = None # db connection
     db_fields = None
+    stored_ids = None # ids already in the db table, kept in memory instead of querying per row
+    DB_WRITER = True # bulk writer (WAL, batched transactions); False: pandas to_sql
+    writer = None
     csv_save = None
+    csv_started = False # header written, further rows are appended
 
     #cols = None
     #dtypes = None
@@ -168,6 +278,17 @@ class Pipeline:
 
     classifiers = {}
 
+    CHUNK_SIZE = CHUNK_SIZE # rows per chunk of main data
+    CSV_ENGINE = None # "pyarrow" for the pyarrow reader, if installed
+
+    # streaming: extract shards of at most ROWS_PER_SHARD rows are classified by CLASS_WORKERS processes
+    # while extraction goes on, with at most QUEUE_DEPTH shards between extraction and the writer
+    ROWS_PER_SHARD = 100000
+    CLASS_WORKERS = max(1, NUM_PROC)
+    QUEUE_DEPTH = 2 * max(1, NUM_PROC)
+    SHARED_MAIN = True # main data loaded once and joined by the classifier workers; False: re-read in chunks per shard
+    MULTI_TAG = True # all tags in one pass over the chunks; False: one pass per tag
+
     # class functions
     def __init__(self, SETTINGS, project_settings):
         #print("Setting up...")
@@ -189,6 +310,13 @@ class Pipeline:
         self.settings = SETTINGS
         self.project_settings = project_settings
         self.keep_text = SETTINGS['keep_text']
+        self.CHUNK_SIZE = SETTINGS.get('chunk_size', CHUNK_SIZE)
+        self.CSV_ENGINE = SETTINGS.get('csv_engine', None)
+        self.ROWS_PER_SHARD = SETTINGS.get('rows_per_shard', 100000)
+        self.CLASS_WORKERS = SETTINGS.get('class_workers', max(1, NUM_PROC))
+        self.QUEUE_DEPTH = SETTINGS.get('queue_depth', 2 * self.CLASS_WORKERS)
+        self.SHARED_MAIN = SETTINGS.get('shared_main', True)
+        self.MULTI_TAG = SETTINGS.get('multi_tag', True)
         
         self.tags = SETTINGS['tags']
         self.convert_t = {k:int for k in self.tags}
@@ -228,6 +356,7 @@ class Pipeline:
             self.db_fields = SETTINGS['db_fields']
             self.db_path = (path / "{}.db".format(SETTINGS['db_name'])).as_posix()
             self.db_table = SETTINGS['db_table']
+            self.DB_WRITER = SETTINGS.get('db_writer', True)
             
             self.init_db()
         else:
@@ -253,7 +382,11 @@ class Pipeline:
         pass
     
     def init_db(self):
-        self.con = sqlite3.connect(self.db_path)
+        if self.DB_WRITER == True:
+            self.writer = DBWriter(self.db_path, self.db_table)
+            self.con = self.writer.con
+        else:
+            self.con = sqlite3.connect(self.db_path)
 
         # reset db
         cursor = self.con.cursor()
@@ -266,37 +399,39 @@ class Pipeline:
         cursor.execute(create)
 
         self.con.commit()
+        self.stored_ids = set() # fresh table
         logging.getLogger("messages").info("PIPELINE: {} table created".format(self.db_table))
 
+    # main data, streamed chunk by chunk over all main files
+    def main_chunks(self):
+        logging.getLogger("messages").info("PIPELINE: getting data from {} main files".format(len(self.settings['main']['files'])))
+        for f in self.settings['main']['files']:
+            for complete_df in read_csv_chunks(f, self.settings['main']['delim'], self.settings['main']['fields'], 
+                                        self.CHUNK_SIZE, self.CSV_ENGINE, dtype=None, encoding='latin-1'):
+                if self.settings['extract']['id'] is not None:
+                    complete_df = complete_df.rename(columns={self.settings['main']['id']:'id'})
+                    complete_df = complete_df.set_index('id')     
+                complete_df.columns = map(str.lower, complete_df.columns)
+                yield complete_df
+
+    # main data columns, as named after main_chunks
+    def main_columns(self):
+        return [x.lower() for x in self.settings['main']['fields'] if x != self.settings['main']['id']]
+
+    # all main data as one table, read once per run
+    def load_main(self):
+        main = pd.concat(list(self.main_chunks()), axis=0)
+        logging.getLogger("messages").info("PIPELINE: {} main rows loaded".format(len(main.index)))
+        return main
+
     def get_data(self, csv):
         if self.main_dir is not None:
-            all_dfs = []
-            logging.getLogger("messages").info("PIPELINE: getting data from {} main files".format(len(self.settings['main']['files'])))
-            for f in self.settings['main']['files']:
-                temp_df = pd.read_csv(f, delimiter=self.settings['main']['delim'], 
-                                encoding='latin-1', usecols=self.settings['main']['fields'])
-                all_dfs.append(temp_df)
-
-            complete_df = pd.concat(all_dfs, ignore_index=True)
-
-            if self.settings['extract']['id'] is not None:
-                complete_df = complete_df.rename(columns={self.settings['main']['id']:'id'})
-                complete_df = complete_df.set_index('id')     
-            complete_df.columns = map(str.lower, complete_df.columns)
+            complete_df = self.main_chunks() # joined lazily in merge_store
         else:
             complete_df = None
 
-        # load all csv data
-        data = []
-        cols = [x if x != self.settings['extract']['text'] else "text" for x in self.settings['extract']['fields']]
-
         logging.getLogger("messages").info("PIPELINE: getting data from {} extract files".format(len(csv)))
-        for c in csv:
-            temp_df = pd.read_csv(c, usecols=cols)
-            data.append(temp_df)
-        if self.settings['extract']['id'] is not None:
-            df = pd.concat(data, axis=0, ignore_index=True)
-            df = df.rename(columns={self.settings['extract']['id']:'id'}).set_index('id')
+        df = read_extract(csv, self.settings['extract'])
 
         return complete_df, df
 
@@ -308,50 +443,63 @@ class Pipeline:
         #print("Classifying {}...".format(tag), flush=True)
         return _class_helper_(self.classifiers[tag], self.proc_keywords[tag], texts)
 
-    def merge_store(self, complete, csv):
+    def merge_store(self, complete, csv, seen=None):
         #print("Merging and storing to DB... ", end="", flush=True)
         logging.getLogger("messages").info("PIPELINE: merging and storing")
 
         if complete is None:
-            merged_df = csv
+            chunks = [csv]
         else:
-            merged_df = complete.join(csv, how="left").fillna(0).astype(self.convert_t)
+            chunks = (c.join(csv, how="left").fillna(0).astype(self.convert_t) for c in complete)
 
+        if seen is None:
+            seen = set() # ids stored by earlier chunks
+        for merged_df in chunks:
+            self.store_chunk(merged_df, seen)
+        #print("Finished.")
+
+    def store_chunk(self, merged_df, seen):
         # revert back to original column names
         merged_df.index.name = self.settings['extract']['id']
         if self.keep_text == True:
             merged_df = merged_df.rename(columns={'text':self.settings['extract']['text']})
            
-        # check for already existing ids in db
+        # drop ids already in the db, in one set lookup
         if self.settings['do_db'] == True:
-            new_con = sqlite3.connect(self.db_path)
-            include = []
-            for tup in merged_df.itertuples():
-                id = tup[0]
-                cursor = new_con.cursor()
-                cursor.execute("select {} from {} where {}={};".format(self.settings['extract']['id'], 
-                                self.db_table, self.settings['extract']['id'], id))
-                res = cursor.fetchall()
-                if len(res) > 0:
-                    include.append(0)
-                else:
-                    include.append(1)
-                cursor.close()
-            
-            merged_df['include'] = include
-
-            merged_df = merged_df[merged_df['include'] == 1]
-            merged_df = merged_df.drop(['include'], axis=1)
+            merged_df = merged_df[~merged_df.index.isin(self.stored_ids)]
 
         merged_df = merged_df[~merged_df.index.duplicated(keep='first')]
+        merged_df = merged_df[~merged_df.index.isin(seen)]
+        seen.update(merged_df.index)
 
         if self.settings['do_db'] == True:
+            if self.writer is not None:
+                self.writer.write(merged_df)
+            else:
+                start = time.time()
+                merged_df.to_sql(self.db_table, con=self.con, if_exists="append", method=insert_or_ignore)
+                logging.getLogger("messages").info("PIPELINE: {} rows stored ({:.0f} rows/sec)".format(len(merged_df.index), len(merged_df.index) / max(time.time() - start, 1e-9)))
             logging.getLogger("messages").info("PIPELINE: saved to DB ({})".format(self.db_table))
-            merged_df.to_sql(self.db_table, con=self.con, if_exists="append")
+            self.stored_ids.update(merged_df.index)
         else:
             logging.getLogger("messages").info("PIPELINE: saved to CSV ({})".format(self.csv_save))
-            merged_df.to_csv(self.csv_save)
-        #print("Finished.")
+            merged_df.to_csv(self.csv_save, mode="a" if self.csv_started == True else "w", header=not self.csv_started)
+            self.csv_started = True
+
+    # store a classified shard; it is joined with the main data by the worker, or here, chunk by chunk
+    def store_shard(self, csv, seen):
+        if self.main_dir is not None and self.SHARED_MAIN == False:
+            for complete in self.main_chunks():
+                self.store_chunk(join_main(complete, csv, self.convert_t), seen)
+        else:
+            self.store_chunk(csv, seen)
+
+    # main rows whose id was in no shard, with 0 for the shard columns
+    def store_rest(self, main, seen, columns):
+        rest = main[~main.index.isin(seen)].fillna(0)
+        for c in columns:
+            rest[c] = 0
+        self.store_chunk(rest.astype(self.convert_t), seen)
 
     def do_pipeline(self):
         #to_do = [f for f in self.data_dir.rglob("*{}".format(self.settings['extract']['ext']))]
@@ -362,33 +510,65 @@ class Pipeline:
 
         yield "Extracting"
         logging.getLogger("messages").info("PIPELINE: extraction started")
-        #e = Extract(to_do, self.csv_dir, self.settings['extract']['fields'], 
-        #            self.n, SETTINGS=self.project_settings, KEYS=self.all_keywords, MODE=self.MODE,
-        #            FILE_EXT=self.settings['file_extract'])
-        #csv_files = e.extract()
-        csv_files = [x for x in (self.csv_dir.parent / "24257").rglob("*.csv")]
-
-        for c in csv_files:
+        e = Extract(to_do, self.csv_dir, self.settings['extract']['fields'], 
+                    self.n, SETTINGS=self.project_settings, KEYS=self.all_keywords, MODE=self.MODE,
+                    FILE_EXT=self.settings['file_extract'], SHARD_FILES=True, ROWS_PER_SHARD=self.ROWS_PER_SHARD)
+
+        # extraction (in Extract's pool) -> classification (classifier pool) -> storing (here, the only writer)
+        # every input is split into shards of ROWS_PER_SHARD rows, each passed on as soon as it is written,
+        # so the stages overlap within a file too; shards are stored in extraction order,
+        # and when QUEUE_DEPTH are in flight, extraction waits for the writer
+        # shard-parallel: the main data is read once, before the workers start, and shared with them read-only
+        if self.main_dir is not None and self.SHARED_MAIN == True:
             yield "Retrieving Data"
-            complete, csv = self.get_data([c])
-
-            tags_to_class = self.tags
-
-            for idx, t in enumerate(tags_to_class):
-                logging.getLogger("messages").info("PIPELINE: classifying tag {}/{} ({})".format(idx+1, len(tags_to_class), t))
-                #if self.classifiers[t]["preproc"] == True:
-                #    csv['trimmed'] = self.preproc(t, csv['text'])
-                #    csv[t] = self.do_class(t, csv['trimmed'])
-                #else:
-                yield "Classifying {}".format(t)
-                csv[t] = self.do_class(t, csv['text'])
-
-            if self.keep_text == False:
-                csv = csv.drop(columns=['text', 'trimmed'], axis=1, errors='ignore')
-
-            yield "Storing"
-            self.merge_store(complete, csv)
-
-            del complete
-            del csv
+            main = self.load_main()
+        else:
+            main = None
+
+        job = {"extract":self.settings['extract'], "tags":self.tags, "keep_text":self.keep_text, "multi_tag":self.MULTI_TAG,
+                "keywords":{t:self.proc_keywords[t] for t in self.tags}, "classifiers":{t:self.classifiers[t] for t in self.tags},
+                "main":main, "convert_t":self.convert_t}
+        seen = set() # ids stored so far, in this run
+        columns = list(self.tags) # shard columns, for the main rows in no shard
+        with closing(mp.Pool(self.CLASS_WORKERS, initializer=init_class_pool, initargs=(job,))) as pool:
+            in_flight = deque()
+            stored = 0
+            shards = e.iter_extract()
+            while True:
+                shard = next(shards, None)
+                if shard is not None:
+                    logging.getLogger("messages").info("PIPELINE: classifying {}".format(Path(shard).name))
+                    in_flight.append(pool.apply_async(classify_shard, (shard,)))
+
+                # store whatever is done; block on the oldest shard when the queue is full or extraction is over
+                while len(in_flight) > 0 and (in_flight[0].ready() or len(in_flight) >= self.QUEUE_DEPTH or shard is None):
+                    if in_flight[0].ready() == False:
+                        yield "Classifying (shard {})".format(stored+1)
+                    csv = in_flight.popleft().get()
+                    yield "Storing (shard {})".format(stored+1)
+                    if self.main_dir is not None:
+                        columns = [c for c in csv.columns if c not in self.main_columns()]
+                    self.store_shard(csv, seen)
+                    stored += 1
+                    del csv
+
+                if shard is None:
+                    break
+            pool.close()
+            pool.join()
+        logging.getLogger("messages").info("PIPELINE: {} shard(s) stored".format(stored))
+
+        if main is not None:
+            yield "Storing (remaining main rows)"
+            self.store_rest(main, seen, columns)
+            del main
+        elif self.main_dir is not None:
+            yield "Storing (remaining main rows)"
+            for complete in self.main_chunks():
+                self.store_rest(complete, seen, columns)
+
+        if self.writer is not None:
+            yield "Indexing"
+            self.writer.finish([x.lower() for x in self.tags])
+            self.writer = None
         yield "Pipeline Complete."
@@ -0,0 +1,110 @@
+# Author: Stephen Meisenbacher
+# Reader.py
+# chunked readers for delimited input, so large files never have to fit in memory
+
+import pandas as pd
+import numpy as np
+from pathlib import Path
+
+# optional faster parser and columnar shards (pip install pyarrow)
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from pyarrow import csv as pa_csv
+except ImportError:
+    pa = pq = pa_csv = None
+
+CHUNK_SIZE = 100000 # rows per chunk
+BLOCK_SIZE = 16*1024*1024 # bytes per pyarrow block
+SHARD_SUFFIXES = [".csv", ".parquet"] # extract output formats
+
+# yields DataFrames of about chunksize rows, holding only usecols (in that order)
+# engine: None / "c" for pandas, "pyarrow" for the pyarrow streaming reader (falls back to pandas if not installed)
+def read_csv_chunks(f, delimiter=",", usecols=None, chunksize=CHUNK_SIZE, engine=None, dtype=str, encoding="utf-8"):
+    if engine == "pyarrow" and pa_csv is not None:
+        yield from read_arrow_chunks(f, delimiter, usecols, chunksize, dtype, encoding)
+        return
+
+    reader = pd.read_csv(f, delimiter=delimiter, usecols=usecols, dtype=dtype, encoding=encoding, chunksize=chunksize)
+    with reader:
+        for chunk in reader:
+            yield chunk[usecols] if usecols is not None else chunk
+
+def read_arrow_chunks(f, delimiter, usecols, chunksize, dtype, encoding):
+    read_options = pa_csv.ReadOptions(block_size=BLOCK_SIZE, encoding=encoding)
+    parse_options = pa_csv.ParseOptions(delimiter=delimiter)
+    if dtype == str:
+        # keep everything as text, with the same missing values pandas would produce
+        convert_options = pa_csv.ConvertOptions(include_columns=usecols, strings_can_be_null=True,
+                                                auto_dict_encode=False, column_types={c:"string" for c in usecols or []})
+    else:
+        convert_options = pa_csv.ConvertOptions(include_columns=usecols)
+
+    if not hasattr(f, "read"):
+        f = str(f) # paths as plain strings
+    batches = pa_csv.open_csv(f, read_options=read_options, parse_options=parse_options, convert_options=convert_options)
+    buffer = []
+    rows = 0
+    for batch in batches:
+        buffer.append(batch.to_pandas())
+        rows += batch.num_rows
+        if rows >= chunksize:
+            yield to_chunk(buffer, dtype)
+            buffer = []
+            rows = 0
+    if len(buffer) > 0:
+        yield to_chunk(buffer, dtype)
+
+def to_chunk(frames, dtype):
+    chunk = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+    if dtype == str:
+        chunk = chunk.astype(object).where(chunk.notna(), np.nan)
+    return chunk
+
+######## EXTRACT SHARDS #########
+# all extract shards below a directory, csv or parquet
+def shard_files(parent):
+    return sorted(f for f in Path(parent).rglob("*") if f.suffix in SHARD_SUFFIXES and f.is_file())
+
+# column names, without reading any rows (parquet keeps its schema in the file footer)
+def shard_columns(fname):
+    if Path(fname).suffix == ".parquet":
+        return pq.read_schema(Path(fname).as_posix()).names
+    return pd.read_csv(fname, nrows=0).columns.tolist()
+
+# read a shard, only the requested columns; parquet is memory-mapped
+# parquet stores all values as text, so numeric columns are converted back the way read_csv would
+def read_shard(fname, columns=None, dtype=None):
+    if Path(fname).suffix == ".parquet":
+        df = pd.read_parquet(Path(fname).as_posix(), columns=columns, memory_map=True)
+        if dtype is None:
+            for c in df.columns:
+                if c != "text":
+                    try:
+                        df[c] = pd.to_numeric(df[c])
+                    except (ValueError, TypeError):
+                        pass
+        return df
+    return pd.read_csv(fname, usecols=columns, dtype=dtype, na_filter=dtype is None)
+
+# parquet writer for one shard, every column stored as text
+def open_shard_writer(save_name, fields):
+    if pq is None:
+        raise ImportError("pyarrow is required for parquet shards (pip install pyarrow)")
+    schema = pa.schema([(f, pa.string()) for f in fields])
+    return pq.ParquetWriter(Path(save_name).as_posix(), schema)
+
+def write_shard_batch(df, writer):
+    table = pa.Table.from_pandas(df.astype(str), schema=writer.schema, preserve_index=False)
+    writer.write_table(table)
+
+######## RULE FILES #########
+# rules, tag columns and per rule {encoding, prio} of a rule file, parsed once per run
+def read_rule_table(rule_file):
+    rule_data = pd.read_csv(rule_file)
+    rules = rule_data['rule'].to_list()
+    tags = rule_data.columns[2:].to_list()
+    rule_tags = {}
+    for row in rule_data.to_dict("records"):
+        rule_tags[row['rule']] = {'encoding':{t:row[t] for t in tags}, 'prio':row['prio']}
+    return rules, tags, rule_tags
@@ -10,7 +10,6 @@ import nltk
 nltk.download("punkt", quiet=True)
 from nltk.tokenize import word_tokenize, sent_tokenize
 
-from pathlib import Path
 #import multiprocessing
 import multiprocess as mp
 import swifter
@@ -18,6 +17,8 @@ from contextlib import closing
 
 from collections import Counter
 
+from Reader import read_shard, shard_files
+
 def left_trim(x, n):
     return max(0, int(len(x.split())/2) - n)
 def right_trim(x,n):
@@ -59,13 +60,12 @@ class Text_Ex:
 
 
     def _helper_(self, fname):
-        df = pd.read_csv(fname)
+        df = read_shard(fname, columns=["text"])
         counts = df["text"].swifter.progress_bar(False).apply(get_context_new, args=[self.n, self.chunk, self.keywords]).to_list()
         return counts
 
     def do_lr(self):
-        path = Path(self.parent).rglob("*.csv")
-        files = [x for x in path]
+        files = shard_files(self.parent)
         global_counts = Counter()
         logging.getLogger("messages").info("TEXT EXTRACT: running on {} file(s)".format(len(files)))
         with closing(mp.Pool(self.num_procs)) as pool:
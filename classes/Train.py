@@ -6,21 +6,24 @@
 import os
 import sys
 import pandas as pd
-import re
 import swifter
 from pathlib import Path
 import random
 import multiprocessing as mp
 import pickle
+import json
 import logging
 from contextlib import closing
 from pandarallel import pandarallel
+from Reader import read_shard, shard_files, read_rule_table, read_csv_chunks, CHUNK_SIZE
+from Matcher import get_rule_set
 
 import numpy as np
+from scipy import sparse
 from sklearn.pipeline import Pipeline
 from sklearn.model_selection import train_test_split
 from sklearn.naive_bayes import MultinomialNB
-from sklearn.feature_extraction.text import  TfidfVectorizer
+from sklearn.feature_extraction.text import  TfidfVectorizer, HashingVectorizer, TfidfTransformer
 from sklearn.multiclass import OneVsRestClassifier
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.multioutput import MultiOutputClassifier
@@ -33,6 +36,31 @@ from nltk.corpus import stopwords
 
 pandarallel.initialize()
 
+NUM_PROC = int(0.75 * mp.cpu_count())
+
+# for worker access: the training object (with its parsed rule table) and the shared features, shipped once per worker
+def init_pool(t, features=None):
+    global global_train
+    global global_features
+    global_train = t
+    global_features = features
+    get_rule_set(t.rules)
+
+def sample_file(fname):
+    return global_train.__extra_helper__(fname, PARALLEL=False)
+
+def fit_class(job):
+    kind, c, n_jobs = job
+    return global_train.fit_class(kind, c, global_features, n_jobs)
+
+# naive bayes over a hashed feature space: only features seen in training count, as with a fitted vocabulary
+# (otherwise the smoothing mass of the empty hash buckets swamps the class totals)
+def restrict_features(nb, seen):
+    fc = nb.feature_count_[:, seen] + nb.alpha
+    log_prob = np.zeros_like(nb.feature_log_prob_)
+    log_prob[:, seen] = np.log(fc) - np.log(fc.sum(axis=1, keepdims=True))
+    nb.feature_log_prob_ = log_prob
+
 def get_labels(data):
     labels = []
     for _, row in data.iterrows():
@@ -40,30 +68,27 @@ def get_labels(data):
 
     return np.stack(labels, axis=0)
 
-def get_matches(text, neg_sample, rules, classes, rule_tags):
+def get_matches(text, neg_sample, rule_set, classes, rule_tags):
     temp = []
     splitted = text.split('|')
-    for r in rules:
-        match = []
-        plus = 0
-        for x in splitted:
-            if "REGEX" in r:
-                regex = re.compile(r.split(':::')[1])
-                if re.search(regex, x):
-                    match.append((x,1))
-                    plus += 1
-                elif plus > 0 and neg_sample == True:
-                    if not any(ru in x for ru in rules):
-                        match.append((x,0))
-                        plus -= classes
-            else:
-                if r in x:
-                    match.append((x,1))
+    hits, contains = rule_set.match(splitted) # one pass over all rules
+    for r in rule_set.rules:
+        if len(hits[r]) == 0:
+            continue
+        if neg_sample == True:
+            # negatives: chunks without any rule, following a hit
+            hit = set(hits[r])
+            match = []
+            plus = 0
+            for idx in range(hits[r][0], len(splitted)):
+                if idx in hit:
+                    match.append((splitted[idx],1))
                     plus += 1
-                elif plus > 0 and neg_sample == True:
-                    if not any(ru in x for ru in rules):
-                        match.append((x,0))
-                        plus -= classes
+                elif plus > 0 and contains[idx] == False:
+                    match.append((splitted[idx],0))
+                    plus -= classes
+        else:
+            match = [(splitted[idx],1) for idx in hits[r]]
         random.shuffle(match)
         for m in match:
             if m[1] == 1:
@@ -80,6 +105,7 @@ class Train:
     parent = None
     rule_file = None
     rules = None
+    rule_set = None
     tags = None
     classes = None
     rule_tags = None
@@ -89,23 +115,24 @@ class Train:
     N_ESTIMATORS = None
     min_samples_split = None
     min_samples_leaf = None
+    N_JOBS = None # cores for training, shared by the per-class workers and each forest's n_jobs (None: NUM_PROC)
 
-    def __init__(self, pid, basename, parent, rf, sample, neg_sample, project, N_ESTIMATORS=None, min_samples_split=None, min_samples_leaf=None):
+    # out-of-core mode: the training data is never held in memory as a whole
+    OUT_OF_CORE = False
+    CHUNK_SIZE = CHUNK_SIZE # rows per chunk
+    N_FEATURES = 2**20 # hashed feature space
+
+    def __init__(self, pid, basename, parent, rf, sample, neg_sample, project, N_ESTIMATORS=None, min_samples_split=None, min_samples_leaf=None, N_JOBS=None,
+                 OUT_OF_CORE=False, CHUNK_SIZE=CHUNK_SIZE):
         self.pid = pid
         self.project = project
         self.basename = basename
         self.parent = Path(parent)
         self.rule_file = Path(rf)
 
-        rule_data = pd.read_csv(self.rule_file)
-        self.rules = rule_data['rule'].to_list()
-        self.tags = rule_data.columns[2:].to_list()
+        self.rules, self.tags, self.rule_tags = read_rule_table(self.rule_file)
+        self.rule_set = get_rule_set(self.rules)
         self.classes = len(self.tags)
-        self.rule_tags = {}
-        for _, row in rule_data.iterrows():
-            self.rule_tags[row['rule']] = {}
-            self.rule_tags[row['rule']]['encoding'] = row[2:].to_dict()
-            self.rule_tags[row['rule']]['prio'] = row['prio']
 
         self.sample = float(sample)
         self.neg_sample = neg_sample
@@ -113,12 +140,16 @@ class Train:
         self.N_ESTIMATORS = N_ESTIMATORS
         self.min_samples_split = min_samples_split
         self.min_samples_leaf = min_samples_leaf
+        self.N_JOBS = N_JOBS
+        self.OUT_OF_CORE = OUT_OF_CORE
+        self.CHUNK_SIZE = CHUNK_SIZE
 
         logging.getLogger("messages").info("TRAIN: init complete")
 
-    def __extra_helper__(self, fname):
+    # PARALLEL: spread the rows over pandarallel workers (not possible inside a pool worker)
+    def __extra_helper__(self, fname, PARALLEL=True):
         #print("Processing {}...".format(fname.stem), flush=True)
-        sub_df = pd.read_csv(fname)
+        sub_df = read_shard(fname, columns=["text"])
         
         if len(sub_df.index) == 0:
             return None
@@ -126,7 +157,10 @@ class Train:
             sub_df = sub_df.sample(frac=self.sample, random_state=42)
 
         #res = sub_df['text'].swifter.progress_bar(False).apply(lambda x: self.get_matches(x))
-        res = sub_df['text'].parallel_apply(lambda x: get_matches(x, self.neg_sample, self.rules, self.classes, self.rule_tags))
+        if PARALLEL == True:
+            res = sub_df['text'].parallel_apply(lambda x: get_matches(x, self.neg_sample, self.rule_set, self.classes, self.rule_tags))
+        else:
+            res = sub_df['text'].apply(lambda x: get_matches(x, self.neg_sample, self.rule_set, self.classes, self.rule_tags))
         del sub_df
         res = [x for s in res for x in s]
         data = pd.DataFrame(res)
@@ -141,96 +175,201 @@ class Train:
     def extrapolate(self):
         logging.getLogger("messages").info("TRAIN: extrapolation begun")
 
-        path = Path(self.parent).rglob("*.csv")
-        files = [f for f in path if "full" not in f.as_posix()]
+        files = [f for f in shard_files(self.parent) if "full" not in f.as_posix()]
+
+        if (Path(self.project) / "train" / str(self.pid)).is_dir() == False:
+            os.makedirs((Path(self.project) / "train" / str(self.pid)).as_posix())
 
-        all_data = []
-        #with closing(mp.Pool(mp.cpu_count())) as pool:
-        #    all_data = list(pool.map(self.__extra_helper__, files))
-        for f in files:
-            all_data.append(self.__extra_helper__(f))
+        name = Path(self.project) / "train" / str(self.pid) / self.basename
 
-        merged = pd.concat(all_data, ignore_index=True)
-        del all_data
+        # several files: one file per worker, otherwise the rows of the single file are spread out
+        if NUM_PROC > 1 and len(files) > 1:
+            with closing(mp.Pool(min(NUM_PROC, len(files)), initializer=init_pool, initargs=(self,))) as pool:
+                return self.save_training_data(pool.imap(sample_file, files), name)
+        else:
+            return self.save_training_data((self.__extra_helper__(f) for f in files), name)
+
+    # OUT_OF_CORE: the (shuffled) sample of each file is appended as soon as it is ready,
+    # otherwise all samples are merged and shuffled in memory
+    def save_training_data(self, all_data, name):
+        if self.OUT_OF_CORE == True:
+            first = True
+            for data in all_data:
+                if data is None:
+                    continue
+                data = data.reindex(columns=["chunk", "rule"] + self.tags)
+                data.to_csv(name.as_posix(), index=False, mode="w" if first == True else "a", header=first)
+                first = False
+            return name
+
+        merged = pd.concat(list(all_data), ignore_index=True)
         merged = merged.sort_values("match", ascending=False).reset_index(drop=True)
         merged = merged.sample(frac=1, random_state=42).reset_index(drop=True)
         merged = merged.drop(columns=["match"])
 
-        if (Path(self.project) / "train" / str(self.pid)).is_dir() == False:
-            os.makedirs((Path(self.project) / "train" / str(self.pid)).as_posix())
-
-        name = Path(self.project) / "train" / str(self.pid) / self.basename
         merged.to_csv(name.as_posix(), index=False)
         return name
 
-    def train_nb(self, train_file):
-        # get training data
-        data = pd.read_csv(train_file)
-        classes = self.tags
+    # tf-idf features of the train / test split, fitted once per training run and reused by every class
+    # matrices, labels and the fitted preprocessing (tf-idf, plus the scaler for SCALE) are kept on disk, keyed by the training file
+    def features(self, train_file, SCALE=False):
+        feature_dir = Path(self.project) / "train" / str(self.pid) / "features" / ("tfidf_scaled" if SCALE == True else "tfidf")
+        stat = Path(train_file).stat()
+        key = {"train_file":Path(train_file).as_posix(), "size":stat.st_size, "mtime":stat.st_mtime}
+
+        if (feature_dir / "key.json").is_file() and json.loads((feature_dir / "key.json").read_text()) == key:
+            logging.getLogger("messages").info("TRAIN: reusing features in {}".format(feature_dir.as_posix()))
+            with open(feature_dir / "preproc.pkl", 'rb') as f:
+                preproc = pickle.load(f)
+            X_train = sparse.load_npz(feature_dir / "X_train.npz")
+            X_test = sparse.load_npz(feature_dir / "X_test.npz")
+            y_train = pd.read_csv(feature_dir / "y_train.csv")
+            y_test = pd.read_csv(feature_dir / "y_test.csv")
+            return preproc, X_train, X_test, y_train, y_test
 
-        # split data
+        data = pd.read_csv(train_file)
         train, test = train_test_split(data, random_state=42, test_size=0.2)
-        X_train = train['chunk']
-        X_test = test['chunk']
-
-        # setup
-        nb_pipeline = Pipeline([
-                    ('tfidf', TfidfVectorizer(stop_words=stopwords.words('english'))),
-                    ('clf', OneVsRestClassifier(MultinomialNB())),
-                ])
-
-        # train
-        for c in classes:
-            logging.getLogger("messages").info("TRAIN: nb training on {}".format(c))
-
-            nb_pipeline.fit(X_train, train[c])
-            pred = nb_pipeline.predict(X_test)
-            acc = accuracy_score(test[c], pred)
-            prec = precision_score(test[c], pred, zero_division=0)
-            rec = recall_score(test[c], pred, zero_division=0)
-            f1 = f1_score(test[c], pred, zero_division=0)
+        steps = [('tfidf', TfidfVectorizer(stop_words=stopwords.words('english')))]
+        if SCALE == True:
+            steps.append(('scale', StandardScaler(with_mean=False)))
+        preproc = Pipeline(steps)
+        X_train = preproc.fit_transform(train['chunk'])
+        X_test = preproc.transform(test['chunk'])
+        y_train = train[self.tags].reset_index(drop=True)
+        y_test = test[self.tags].reset_index(drop=True)
+
+        os.makedirs(feature_dir.as_posix(), exist_ok=True)
+        with open(feature_dir / "preproc.pkl", 'wb') as f:
+            pickle.dump(preproc, f)
+        sparse.save_npz(feature_dir / "X_train.npz", sparse.csr_matrix(X_train))
+        sparse.save_npz(feature_dir / "X_test.npz", sparse.csr_matrix(X_test))
+        y_train.to_csv(feature_dir / "y_train.csv", index=False)
+        y_test.to_csv(feature_dir / "y_test.csv", index=False)
+        (feature_dir / "key.json").write_text(json.dumps(key)) # last: marks the features as complete
+        logging.getLogger("messages").info("TRAIN: features ({} x {}) saved to {}".format(X_train.shape[0], X_train.shape[1], feature_dir.as_posix()))
+
+        return preproc, X_train, X_test, y_train, y_test
+
+    # fit and save the classifier of one class ("nb" or "rf") on the shared features, returns its scores
+    def fit_class(self, kind, c, features, n_jobs):
+        preproc, X_train, X_test, y_train, y_test = features
+        logging.getLogger("messages").info("TRAIN: {} training on {}".format(kind, c))
+
+        if kind == "rf":
+            clf = RandomForestClassifier(n_estimators=self.N_ESTIMATORS, criterion="gini", 
+                min_samples_leaf=self.min_samples_leaf, min_samples_split=self.min_samples_split, n_jobs=n_jobs, random_state=42)
+        else:
+            clf = OneVsRestClassifier(MultinomialNB())
+        clf.fit(X_train, y_train[c])
+        pred = clf.predict(X_test)
+        acc = accuracy_score(y_test[c], pred)
+        prec = precision_score(y_test[c], pred, zero_division=0)
+        rec = recall_score(y_test[c], pred, zero_division=0)
+        f1 = f1_score(y_test[c], pred, zero_division=0)
+
+        # saved classifiers still take raw text: the shared, already fitted preprocessing goes in front
+        pipeline = Pipeline(preproc.steps + [('clf', clf)])
+        if kind == "rf":
+            pipeline = convert_estimator(pipeline)
+        name = "{}_{}-{}".format(kind.upper(), self.sample, c)
+        save_path = Path(self.project) / "train" / str(self.pid) / "clf" / name
+        with open(save_path, 'wb') as f:
+            pickle.dump(pipeline, f)
+        logging.getLogger("messages").info("TRAIN: classifer saved to {}".format(save_path.as_posix()))
+
+        return {"class":c, "name":save_path.as_posix(), "Accuracy":round(acc,3), "Precision":round(prec,3), 
+                "Recall":round(rec,3), "F1":round(f1,3)}
+
+    # per-class classifiers, yielded as they finish
+    # with a budget of N_JOBS cores, classes are trained by up to N_JOBS workers, each forest using the cores left per worker
+    def train_classes(self, kind, train_file):
+        # vectorize (and for rf scale) once for all classes
+        features = self.features(train_file, SCALE=(kind == "rf"))
+
+        budget = max(1, self.N_JOBS if self.N_JOBS is not None else NUM_PROC)
+        workers = min(budget, len(self.tags))
+        if workers > 1:
+            jobs = [(kind, c, max(1, budget // workers)) for c in self.tags]
+            with closing(mp.Pool(workers, initializer=init_pool, initargs=(self, features))) as pool:
+                for res in pool.imap_unordered(fit_class, jobs):
+                    yield res
+        else:
+            for c in self.tags:
+                yield self.fit_class(kind, c, features, budget)
 
+    def train_nb(self, train_file):
+        if self.OUT_OF_CORE == True:
+            yield from self.train_nb_stream(train_file)
+        else:
+            yield from self.train_classes("nb", train_file)
+
+    # chunks of the training file, each with a mask of its held-out (test) rows: 20%, the same on every pass
+    def stream_split(self, train_file):
+        chunks = read_csv_chunks(train_file, usecols=["chunk"] + self.tags, chunksize=self.CHUNK_SIZE, dtype={"chunk":str})
+        for i, chunk in enumerate(chunks):
+            chunk["chunk"] = chunk["chunk"].fillna("")
+            test = np.random.default_rng([42, i]).random(len(chunk.index)) < 0.2
+            yield chunk, test
+
+    # out-of-core naive bayes: the training file is streamed in chunks, featurized by hashing (no vocabulary to fit)
+    # with a running idf estimate, and every class model is updated per chunk with partial_fit;
+    # a second pass scores the held-out rows, so memory stays bounded by the chunk size
+    def train_nb_stream(self, train_file):
+        hasher = HashingVectorizer(stop_words=stopwords.words('english'), n_features=self.N_FEATURES, alternate_sign=False, norm=None)
+        idf = TfidfTransformer()
+        df = np.zeros(self.N_FEATURES, dtype=np.int64)
+        docs = 0
+        models = {c:MultinomialNB() for c in self.tags}
+
+        for i, (chunk, test) in enumerate(self.stream_split(train_file)):
+            train = chunk[~test]
+            if len(train.index) > 0:
+                X = hasher.transform(train["chunk"])
+                df += np.bincount(X.indices, minlength=self.N_FEATURES) # one entry per (row, feature)
+                docs += X.shape[0]
+                idf.idf_ = np.log((1 + docs) / (1 + df)) + 1 # smoothed, as TfidfVectorizer
+                X = idf.transform(X)
+                for c in self.tags:
+                    models[c].partial_fit(X, train[c].to_numpy(), classes=[0, 1])
+            logging.getLogger("messages").info("TRAIN: nb chunk {} done ({} training rows so far)".format(i + 1, docs))
+
+        # the saved classifiers take raw text, with the final idf; unseen features are dropped
+        if docs == 0:
+            raise ValueError("no training rows in {}".format(train_file))
+        seen = df > 0
+        idf.idf_ = np.where(seen, idf.idf_, 0)
+        for c in self.tags:
+            restrict_features(models[c], seen)
+        preproc = Pipeline([('hash', hasher), ('tfidf', idf)])
+
+        # tp, fp, fn, tn per class
+        counts = {c:np.zeros(4, dtype=np.int64) for c in self.tags}
+        for chunk, test in self.stream_split(train_file):
+            test = chunk[test]
+            if len(test.index) == 0:
+                continue
+            X = preproc.transform(test["chunk"])
+            for c in self.tags:
+                pred = models[c].predict(X) == 1
+                y = test[c].to_numpy() == 1
+                counts[c] += [np.sum(pred & y), np.sum(pred & ~y), np.sum(~pred & y), np.sum(~pred & ~y)]
+
+        for c in self.tags:
+            tp, fp, fn, tn = counts[c]
+            acc = (tp + tn) / max(1, tp + fp + fn + tn)
+            prec = tp / (tp + fp) if tp + fp > 0 else 0
+            rec = tp / (tp + fn) if tp + fn > 0 else 0
+            f1 = 2 * tp / (2 * tp + fp + fn) if tp + fp + fn > 0 else 0
+
+            nb_pipeline = Pipeline(preproc.steps + [('clf', models[c])])
             name = "NB_{}-{}".format(self.sample, c)
             save_path = Path(self.project) / "train" / str(self.pid) / "clf" / name
-            pickle.dump(nb_pipeline, open(save_path, 'wb'))
+            with open(save_path, 'wb') as f:
+                pickle.dump(nb_pipeline, f)
             logging.getLogger("messages").info("TRAIN: classifer saved to {}".format(save_path.as_posix()))
 
-            yield {"class":c, "name":save_path.as_posix(), "Accuracy":round(acc,3), "Precision":round(prec,3), 
-                    "Recall":round(rec,3), "F1":round(f1,3)}
+            yield {"class":c, "name":save_path.as_posix(), "Accuracy":round(float(acc),3), "Precision":round(float(prec),3), 
+                    "Recall":round(float(rec),3), "F1":round(float(f1),3)}
 
     def train_rf(self, train_file):
-        data = pd.read_csv(train_file)
-        classes = self.tags
-
-        # split data
-        train, test = train_test_split(data, random_state=42, test_size=0.2)
-        X_train = train['chunk']
-        y_train = train.iloc[:,1:]
-        X_test = test['chunk']
-        y_test = np.array(test.iloc[:,1:])
-
-        rf_pipeline = Pipeline([
-                ('tfidf', TfidfVectorizer(stop_words=stopwords.words('english'))),
-                ('scale', StandardScaler(with_mean=False)),
-                ('clf', RandomForestClassifier(n_estimators=self.N_ESTIMATORS, criterion="gini", 
-                min_samples_leaf=self.min_samples_leaf, min_samples_split=self.min_samples_split, n_jobs=-1, random_state=42)),
-            ])
-
-        for c in classes:
-            logging.getLogger("messages").info("TRAIN: rf training on {}".format(c))
-
-            rf_pipeline.fit(X_train, train[c])
-            pure_clf = convert_estimator(rf_pipeline)
-            pred = pure_clf.predict(X_test)
-            acc = accuracy_score(test[c], pred)
-            prec = precision_score(test[c], pred, zero_division=0)
-            rec = recall_score(test[c], pred, zero_division=0)
-            f1 = f1_score(test[c], pred, zero_division=0)
-
-            name = "RF_{}-{}".format(self.sample, c)
-            save_path = Path(self.project) / "train" / str(self.pid) / "clf" / name
-            pickle.dump(pure_clf, open(save_path, 'wb'))
-            logging.getLogger("messages").info("TRAIN: classifer saved to {}".format(save_path.as_posix()))
-
-            yield {"class":c, "name":save_path.as_posix(), "Accuracy":round(acc,3), "Precision":round(prec,3), 
-                    "Recall":round(rec,3), "F1":round(f1,3)}
\ No newline at end of file
+        yield from self.train_classes("rf", train_file)
@@ -0,0 +1,120 @@
+# Author: Stephen Meisenbacher
+# VectorIndex.py
+# approximate nearest neighbour search over embeddings (inverted file index, cosine similarity)
+
+import numpy as np
+from EmbedCache import unit_rows
+
+NPROBE = 8 # lists searched per query (all lists: exact search)
+ITERATIONS = 10 # k-means rounds for the coarse centroids
+TRAIN_PER_LIST = 256 # training sample size per list
+QUERY_BATCH = 4096 # queries scored at once
+
+# spherical k-means: k unit centroids, trained on a sample of the (unit) vectors
+def train_centroids(vectors, k, ITERATIONS=ITERATIONS, seed=42):
+    rng = np.random.default_rng(seed)
+    sample = vectors[rng.choice(len(vectors), min(len(vectors), k * TRAIN_PER_LIST), replace=False)]
+    centroids = sample[rng.choice(len(sample), k, replace=False)]
+    for _ in range(ITERATIONS):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        counts = np.bincount(assign, minlength=k)
+        centroids = unit_rows(np.where(counts[:, None] > 0, sums, centroids)) # empty lists keep their centroid
+    return centroids
+
+# vectors are split into NLIST lists by their nearest centroid; a query only scores the NPROBE lists closest to it
+class IVFIndex:
+    vectors = None # unit rows, ordered by list
+    ids = None # position in the original vectors, per row
+    offsets = None # rows of list l: offsets[l]:offsets[l+1]
+    centroids = None
+    NPROBE = NPROBE
+
+    def __init__(self, vectors, NLIST=None, NPROBE=NPROBE, ITERATIONS=ITERATIONS):
+        vectors = unit_rows(vectors)
+        if NLIST is None:
+            NLIST = int(np.sqrt(len(vectors)))
+        NLIST = max(1, min(NLIST, len(vectors)))
+        self.NPROBE = max(1, min(NPROBE, NLIST))
+
+        if NLIST > 1:
+            self.centroids = train_centroids(vectors, NLIST, ITERATIONS=ITERATIONS)
+            assign = np.argmax(vectors @ self.centroids.T, axis=1)
+        else:
+            self.centroids = np.zeros((1, vectors.shape[1]), dtype=np.float32)
+            assign = np.zeros(len(vectors), dtype=np.int64)
+
+        self.ids = np.argsort(assign, kind="stable")
+        self.vectors = vectors[self.ids]
+        self.offsets = np.searchsorted(assign[self.ids], np.arange(NLIST + 1))
+
+    def __len__(self):
+        return len(self.ids)
+
+    # (query, list) pairs to score: every query with each of its NPROBE closest lists
+    def probes(self, queries):
+        nlist = len(self.centroids)
+        if self.NPROBE >= nlist:
+            return np.repeat(np.arange(len(queries)), nlist), np.tile(np.arange(nlist), len(queries))
+        coarse = queries @ self.centroids.T
+        probe = np.argpartition(-coarse, self.NPROBE - 1, axis=1)[:, :self.NPROBE]
+        return np.repeat(np.arange(len(queries)), self.NPROBE), probe.ravel()
+
+    # scores of the probed lists, per list: (query positions, row positions, similarities)
+    def scan(self, queries):
+        q_of, l_of = self.probes(queries)
+        order = np.argsort(l_of, kind="stable")
+        q_of, l_of = q_of[order], l_of[order]
+        bounds = np.searchsorted(l_of, np.arange(len(self.centroids) + 1))
+        for l in range(len(self.centroids)):
+            qs = q_of[bounds[l]:bounds[l+1]]
+            start, end = self.offsets[l], self.offsets[l+1]
+            if len(qs) == 0 or start == end:
+                continue
+            yield qs, np.arange(start, end), queries[qs] @ self.vectors[start:end].T
+
+    # threshold query: all (query, vector id, similarity) with similarity > threshold
+    def range_search(self, queries, threshold):
+        found_q, found_id, found_sim = [], [], []
+        for b in range(0, len(queries), QUERY_BATCH):
+            batch = unit_rows(queries[b:b+QUERY_BATCH])
+            for qs, rows, sims in self.scan(batch):
+                i, j = np.nonzero(sims > threshold)
+                found_q.append(qs[i] + b)
+                found_id.append(self.ids[rows[j]])
+                found_sim.append(sims[i, j])
+        if len(found_q) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        return np.concatenate(found_q), np.concatenate(found_id), np.concatenate(found_sim)
+
+    # top-k query: (ids, similarities), both (queries, k), most similar first; -1 / -inf where fewer were found
+    def search(self, queries, k):
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        best = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for b in range(0, len(queries), QUERY_BATCH):
+            batch = unit_rows(queries[b:b+QUERY_BATCH])
+            cand_q, cand_id, cand_sim = [], [], []
+            for qs, rows, sims in self.scan(batch):
+                if sims.shape[1] > k: # keep at most k per query and list
+                    top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+                    sims = np.take_along_axis(sims, top, axis=1)
+                    rows = rows[top]
+                else:
+                    rows = np.broadcast_to(rows, sims.shape)
+                cand_q.append(np.repeat(qs, sims.shape[1]))
+                cand_id.append(self.ids[rows].ravel())
+                cand_sim.append(sims.ravel())
+            if len(cand_q) == 0:
+                continue
+
+            cand_q = np.concatenate(cand_q)
+            cand_id = np.concatenate(cand_id)
+            cand_sim = np.concatenate(cand_sim)
+            order = np.lexsort((-cand_sim, cand_q))
+            cand_q, cand_id, cand_sim = cand_q[order], cand_id[order], cand_sim[order]
+            rank = np.arange(len(cand_q)) - np.searchsorted(cand_q, cand_q) # position within its query
+            keep = rank < k
+            ids[cand_q[keep] + b, rank[keep]] = cand_id[keep]
+            best[cand_q[keep] + b, rank[keep]] = cand_sim[keep]
+        return ids, best
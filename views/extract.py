@@ -70,6 +70,26 @@ def get_layout(project):
                 ],
                 style={"display":"inline-block", "padding":"1rem"})
     
+    inc_switch = html.Div(children=[html.Div(html.P(children="Reuse previous results? \t"), style={"display":"inline-block", "padding-right":"1rem"}), 
+                html.Div(daq.BooleanSwitch(id="inc-switch", on=False), style={"display":"inline-block"}),
+                dbc.Tooltip(
+                    "Input files that have not changed since an earlier extraction (same N, chunks and numbers) are not processed again. Only newly added keywords are searched for.",
+                    target="inc-switch",
+                    style={"display":"inline-block"}
+                ),
+                ],
+                style={"display":"inline-block", "padding":"1rem"})
+    
+    format_switch = html.Div(children=[html.Div(html.P(children="Columnar output? \t"), style={"display":"inline-block", "padding-right":"1rem"}), 
+                html.Div(daq.BooleanSwitch(id="format-switch", on=False), style={"display":"inline-block"}),
+                dbc.Tooltip(
+                    "Save extracted text as Parquet instead of CSV. Faster to read for training and classification, but not viewable in a spreadsheet.",
+                    target="format-switch",
+                    style={"display":"inline-block"}
+                ),
+                ],
+                style={"display":"inline-block", "padding":"1rem"})
+    
     embed_switch = html.Div(html.Div(children=[
                 html.Div(html.P(id="left-p-embed", children="Text Matching \t"), style={"display":"inline-block", "padding-right":"1rem"}),
                 dbc.Tooltip(
@@ -145,7 +165,7 @@ def get_layout(project):
     hidden_div = html.Div(id="es-hidden", style={"display":"none"})
 
     layout = [interval, dialog, del_dialog, html.H1("Extraction"), html.H3("Time to test out your keywords (+ rules)."),
-                mode_switch, switch, n_input, num_switch, embed_switch, es_button, html.Hr(), loading, loading2, table, hidden_div]
+                mode_switch, switch, n_input, num_switch, inc_switch, format_switch, embed_switch, es_button, html.Hr(), loading, loading2, table, hidden_div]
 
     return layout
 
@@ -162,7 +182,7 @@ def start_proc(e, name, n, mode, q, CLASS, project, basename, id, EMBED, THRESHO
         rules = get_rules(project)
         extra = Extrapolate(pid, basename, extracted, rules, project, id, EMBED=EMBED, THRESHOLD=THRESHOLD, KEYWORDS=keywords)
         saved = extra.extrapolate()
-        logging.getLogger("messages").info("Extrapolation complete: saved to {}".format(saved.as_posix()))
+        logging.getLogger("messages").info("Extrapolation complete: {} file(s) saved to {}".format(len(saved), (Path(project) / "csv" / pid).as_posix()))
     q.put([pid])
 
     return
@@ -232,10 +252,10 @@ def refresh(n, c, data):
 @app.callback(Output("es-dialog", "displayed"),
                 Input("es-button", "n_clicks"),
                 [State("es-mode-switch", "on"), State("es-switch", "on"), 
-                State("es-n", "value"), State("num-switch", "on"),
+                State("es-n", "value"), State("num-switch", "on"), State("inc-switch", "on"), State("format-switch", "on"),
                 State("embed-switch", "on"), State("es-embed-threshold", "value"),
                 State("project", "data")])
-def do_es(n, mode, switch, n_input, keep_num, embed, threshold, data):
+def do_es(n, mode, switch, n_input, keep_num, incremental, columnar, embed, threshold, data):
     global q
 
     if n is None:
@@ -258,6 +278,17 @@ def do_es(n, mode, switch, n_input, keep_num, embed, threshold, data):
         all_keys.extend(keywords[k])
     all_keys = list(set(all_keys))
 
+    # per-file record of earlier extractions, for incremental runs
+    if incremental == True:
+        MANIFEST = Path(data['project']) / "csv" / "manifest.json"
+    else:
+        MANIFEST = None
+
+    if columnar == True:
+        SHARD_FORMAT = "parquet"
+    else:
+        SHARD_FORMAT = "csv"
+
     if embed == True:
         EMBED = True
         THRESHOLD = threshold
@@ -302,7 +333,7 @@ def do_es(n, mode, switch, n_input, keep_num, embed, threshold, data):
                 
                 e = Extract(ext_list=ext_list, csv_dir=(Path(data['project']) / "csv"), 
                             n=n_input, fields=settings[k]["fields"], KEYS=all_keys, SETTINGS=settings, MODE=MODE,
-                            FILE_EXT=file_ext, KEEP_NUM=KEEP_NUM)
+                            FILE_EXT=file_ext, KEEP_NUM=KEEP_NUM, MANIFEST=MANIFEST, SHARD_FORMAT=SHARD_FORMAT)
                 p = Process(target=start_proc, args=(e, name, n_input, MODE, q, False, data['project'], k, settings[k]['id'], EMBED, THRESHOLD, keywords))
 
             else:
@@ -326,7 +357,7 @@ def do_es(n, mode, switch, n_input, keep_num, embed, threshold, data):
 
                 e = Extract(ext_list=ext_list, csv_dir=(Path(data['project']) / "csv"), 
                             n=n_input, fields=settings[k]["fields"], KEYS=all_keys, SETTINGS=settings, MODE=MODE,
-                            FILE_EXT=file_ext)
+                            FILE_EXT=file_ext, MANIFEST=MANIFEST, SHARD_FORMAT=SHARD_FORMAT)
                 p = Process(target=start_proc, args=(e, name, n_input, MODE, q, True, data['project'], k, settings[k]['id'], EMBED, THRESHOLD, keywords))
 
             p.start()
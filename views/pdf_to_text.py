@@ -2,6 +2,7 @@
 # view for pdf-to-text utility
 
 import os
+import sys
 from pathlib import Path
 import tika
 from tika import parser
@@ -10,10 +11,6 @@ import logging
 import json
 import platform
 
-from html import unescape
-from bs4 import BeautifulSoup
-import re
-
 import dash
 from dash import dcc, no_update
 import dash_bootstrap_components as dbc
@@ -22,6 +19,9 @@ from dash.dependencies import Input, Output, State
 from dash.exceptions import PreventUpdate
 import dash_daq as daq
 
+sys.path.append("classes")
+from Cleaner import clean_text
+
 from server import app
 
 tika.initVM()
@@ -48,31 +48,6 @@ def pdf_text(tup):
     else:
         return 0
 
-# utility for quick cleaning text
-def clean(text, ABBREV):
-    if '&' in text:
-        text = unescape(text.strip())
-    if '<' in text:
-        text = BeautifulSoup(text, "lxml").text
-    text = re.sub(r"www\S+", " ", text)
-    text = re.sub(r"\b(?![ai])[a-zA-Z]\b", " ", text)
-    text = re.sub(r"\d+", " ", text)
-    text = text.replace(',',' ')
-    text = text.replace(':',' ').replace('*',' ')
-    text = text.encode("ascii", "ignore").decode()
-    text = re.sub(r"[^0-9a-zA-Z\.\?\! ]+", " ", text)
-    text = " ".join(text.split())
-    text = text.replace(" .", ".")
-    text = re.sub(r"\.{2,}", ".", text)
-
-    # handle abbreviations
-    text = " ".join([ABBREV.get(x.lower(), x) for x in text.split()])
-    text = re.sub(r"(?<!\w)([A-Za-z])\.", r"\1", text)
-
-    text = text.lower()
-
-    return text
-
 def __helper__(tup):
     global abbreviations
     #print(file, flush=True)
@@ -83,7 +58,7 @@ def __helper__(tup):
     text = None
     with open(file.as_posix(), 'r') as f:
         text = f.read()
-        text = clean(text, abbreviations)
+        text = clean_text(text, abbreviations)
 
     save = Path(save_path) / file.name.replace(' ', '_')
     with open(save.as_posix(), 'w') as out:
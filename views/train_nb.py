@@ -67,6 +67,17 @@ def get_layout(project):
                 html.Div(html.P(id="right-p-nb", children="\tOn"), style={"display":"inline-block", "padding":"1rem-left"})], 
                 style={"display":"inline-block", "padding":"1rem"})
 
+    stream_switch = html.Div(children=[html.Div(html.P(id="left-p-nb3", children="Out-of-core: Off\t"), style={"display":"inline-block", "padding-right":"1rem"}), 
+                html.Div(daq.BooleanSwitch(id="nb-stream-switch", on=False), style={"display":"inline-block"}),
+                html.Div(html.P(id="right-p-nb3", children="\tOn"), style={"display":"inline-block", "padding":"1rem-left"}),
+                dbc.Tooltip(
+                    "Stream the training data in chunks instead of loading it at once (for training sets larger than memory).",
+                    target="nb-stream-switch",
+                    style={"display":"inline-block"}
+                ),
+                ], 
+                style={"display":"inline-block", "padding":"1rem"})
+
     slider = html.Div(children=[html.Div(html.P(id="left-p-nb2", children="Sample Rate (%):\t"), style={"display":"inline-block"}),
                         html.Div(dcc.Slider(id="nb-slider", min=1, max=100, step=1, value=10, 
                         marks={x:str(x) for x in [1,5,10,15,20,25,50,100]},
@@ -110,12 +121,12 @@ def get_layout(project):
     hidden_div = html.Div(id="nb-hidden", style={"display":"none"})
 
     layout = [modal, dialog, del_dialog, html.H1("Naive Bayes Training"), html.H3("Train a simple text classifier."), html.Hr(),
-                drop_dir, drop_rules, switch, slider, buttons, html.Hr(), table, loading, interval, hidden_div]
+                drop_dir, drop_rules, switch, stream_switch, slider, buttons, html.Hr(), table, loading, interval, hidden_div]
 
     return layout
 
 q = Queue()
-def start_proc(project, parent, rule, samp, neg, q):
+def start_proc(project, parent, rule, samp, neg, stream, q):
     local_log = {}
 
     pid = str(os.getpid())
@@ -128,8 +139,9 @@ def start_proc(project, parent, rule, samp, neg, q):
     local_log['settings']['rule_file'] = rule.as_posix()
     local_log['settings']['sample_rate'] = samp/100.0
     local_log['settings']['neg_sample'] = neg
+    local_log['settings']['out_of_core'] = stream
 
-    train = Train(pid, name, parent, rule, samp/100.0, neg, project)
+    train = Train(pid, name, parent, rule, samp/100.0, neg, project, OUT_OF_CORE=stream)
 
     path = Path(project) / "train" / str(pid)
     os.makedirs(path.as_posix())
@@ -151,15 +163,15 @@ def start_proc(project, parent, rule, samp, neg, q):
 @app.callback(Output("nb-dialog", "displayed"),
                 Input("nb-button", "n_clicks"),
                 [State("nb-dir-drop", "value"), State("nb-rule-drop", "value"),
-                State("nb-slider", "value"), State("nb-switch", "on"),
+                State("nb-slider", "value"), State("nb-switch", "on"), State("nb-stream-switch", "on"),
                 State("project", "data")])
-def do_nb(n, dir, rule, samp, neg, data):
+def do_nb(n, dir, rule, samp, neg, stream, data):
     global q
     if n is None or rule is None:
         raise PreventUpdate
 
     p = Process(target=start_proc, args=(data['project'], Path(data['project']) / "csv" / dir, 
-                Path(data['project']) / "rules" / "{}.csv".format(rule), int(samp), neg, q))
+                Path(data['project']) / "rules" / "{}.csv".format(rule), int(samp), neg, stream, q))
     p.start()
 
     return False
@@ -2,11 +2,11 @@
 # utility functions
 
 import os
+import sys
 import json
 from pathlib import Path
 import psutil
 from datetime import datetime
-import pandas as pd
 import logging
 import platform
 import subprocess
@@ -16,6 +16,9 @@ from pymongo.errors import ConnectionFailure
 import zlib
 from base64 import urlsafe_b64encode as b64e, urlsafe_b64decode as b64d
 
+sys.path.append("classes")
+from Reader import shard_files, shard_columns
+
 def open_file(path):
     logging.getLogger("messages").info("Opening {}".format(path.as_posix()))
     if platform.system() == "Darwin":
@@ -239,8 +242,8 @@ def get_options(project, FULL=False):
         path = Path(project) / "csv" / l['pid']
         if path.is_dir():
             info = "pid: {}, {}".format(l['pid'], l['name'])
-            for file in path.rglob("*.csv"):
-                cols = pd.read_csv(file).columns
+            for file in shard_files(path):
+                cols = shard_columns(file)
                 if "text" in cols:
                     options.append({"label":info, "value":l['pid']})
                 else: